@@ -875,6 +875,47 @@ exit:
     pthread_mutex_unlock(&sq->lock);
 }
 
+// Return up to 'max' messages read from the serial port (or wait for
+// one if none available).  Returns the number of messages or -1 on exit.
+int __visible
+serialqueue_pull_many(struct serialqueue *sq, struct pull_queue_message *q
+                      , int max)
+{
+    pthread_mutex_lock(&sq->lock);
+    // Wait for message to be available
+    while (list_empty(&sq->receive_queue)) {
+        if (pollreactor_is_exit(sq->pr)) {
+            pthread_mutex_unlock(&sq->lock);
+            return -1;
+        }
+        sq->receive_waiting = 1;
+        int ret = pthread_cond_wait(&sq->cond, &sq->lock);
+        if (ret)
+            report_errno("pthread_cond_wait", ret);
+    }
+
+    // Remove messages from queue
+    int count = 0;
+    while (count < max && !list_empty(&sq->receive_queue)) {
+        struct queue_message *qm = list_first_entry(
+            &sq->receive_queue, struct queue_message, node);
+        list_del(&qm->node);
+        struct pull_queue_message *pqm = &q[count++];
+        memcpy(pqm->msg, qm->msg, qm->len);
+        pqm->len = qm->len;
+        pqm->sent_time = qm->sent_time;
+        pqm->receive_time = qm->receive_time;
+        pqm->notify_id = qm->notify_id;
+        if (qm->len)
+            debug_queue_add(&sq->old_receive, qm);
+        else
+            message_free(qm);
+    }
+
+    pthread_mutex_unlock(&sq->lock);
+    return count;
+}
+
 void __visible
 serialqueue_set_wire_frequency(struct serialqueue *sq, double frequency)
 {
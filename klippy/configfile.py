@@ -5,6 +5,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 from __future__ import annotations
 import sys, os, glob, re, time, logging, configparser, io
+import tempfile, shutil, threading, queue
 #from klippy import Printer
 import locales
 locales.set_locale()
@@ -214,6 +215,72 @@ AUTOSAVE_HEADER = """
 #*#
 """
 
+# Delay used to coalesce bursts of update_config() calls into one write
+SAVE_DEBOUNCE_TIME = 0.5
+
+def write_file_atomic(filename, data):
+    # Write to a synced temporary file and rename it over the original so
+    # that a power loss never leaves a truncated config file behind
+    filename = os.path.realpath(filename)
+    dirname = os.path.dirname(filename)
+    fd, tmpname = tempfile.mkstemp(
+        prefix='.' + os.path.basename(filename) + '.', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(filename, tmpname)
+        except OSError:
+            pass
+        os.replace(tmpname, filename)
+    except:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise
+    dirfd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+# Performs config file writes from a background thread
+class ConfigWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def submit(self, filename, data):
+        if self.stopped:
+            # Reactor is exiting - write inline
+            self._write(filename, data)
+            return
+        self.queue.put((filename, data))
+    def wait(self):
+        self.queue.join()
+    def stop(self):
+        self.stopped = True
+        self.queue.put(None)
+    def _write(self, filename, data):
+        try:
+            write_file_atomic(filename, data)
+        except:
+            logging.exception("Unable to write config file %s", filename)
+    def _run(self):
+        while 1:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            finally:
+                self.queue.task_done()
+
 class PrinterConfig:
     # Поиск новой строки
     line_r = re.compile('\n')
@@ -235,6 +302,12 @@ class PrinterConfig:
         self.status_settings = {}
         self.status_warnings = []
         self.haveUnsavedChanges = False
+        self.writer = ConfigWriter()
+        self.config_cache = {}
+        self.save_timer = None
+        self.deferred_cfgname = ""
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
         gcode = self.printer.lookup_object('gcode')
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("configfile/load_backup_config",
@@ -494,7 +567,7 @@ class PrinterConfig:
     def deprecate(self, section, option, value=None, msg=None):
         self.deprecated[(section, option, value)] = msg
     def _build_status(self, config: ConfigWrapper):
-        self.status_raw_config.clear()
+        self.status_raw_config = {}
         for section in config.get_prefix_sections(''):
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
@@ -513,6 +586,8 @@ class PrinterConfig:
             res['option'] = option
             self.status_warnings.append(res)
             
+    def get_status_fragments(self):
+        return ('config', 'settings')
     def get_status(self, eventtime):
         return {'config': self.status_raw_config,
                 'settings': self.status_settings,
@@ -539,7 +614,44 @@ class PrinterConfig:
         for section in removing_sections:
             self.remove_section(section)
         if save_immediatly:
-            self.save_config(need_restart, need_backup, cfgname)
+            if need_restart or need_backup:
+                self.flush()
+                self.save_config(need_restart, need_backup, cfgname)
+            else:
+                self._schedule_save(cfgname)
+
+    # Deferred saving
+    def _schedule_save(self, cfgname):
+        if self.save_timer is not None and cfgname != self.deferred_cfgname:
+            self.flush()
+        self.deferred_cfgname = cfgname
+        if self.save_timer is None:
+            reactor = self.printer.get_reactor()
+            self.save_timer = reactor.register_timer(
+                self._deferred_save, reactor.monotonic() + SAVE_DEBOUNCE_TIME)
+    def _deferred_save(self, eventtime):
+        reactor = self.printer.get_reactor()
+        reactor.unregister_timer(self.save_timer)
+        self.save_timer = None
+        gcode = self.printer.lookup_object('gcode')
+        try:
+            self.save_config(False, False, self.deferred_cfgname, defer=True)
+        except gcode.error:
+            pass
+        return reactor.NEVER
+    def flush(self):
+        """
+        Метод немедленно выполняет отложенное сохранение (если оно есть) и
+        дожидается окончания записи всех файлов конфигурации. Метод блокирует
+        реактор до завершения записи (включая fsync) и изменяет таймеры
+        реактора, поэтому его нельзя вызывать из обработчика сигнала.
+        """
+        if self.save_timer is not None:
+            self._deferred_save(None)
+        self.writer.wait()
+    def _handle_disconnect(self):
+        self.flush()
+        self.writer.stop()
 
     def set(self, section: str, option = None, value = None, save_immediatly = False) -> None:
         """
@@ -630,10 +742,11 @@ class PrinterConfig:
     
     # Новый сейв конфиг. Может сохранять данные либо с бэкапом, либо без, аналогично с перезагрузкой
     # Сейв конфиг делает полный апдейт (изменяет существующие параметры, удаляет их и записывает новые)
-    def save_config(self, need_restart: bool, need_backup: bool, cfgname: str = "", with_options=False) -> None:
+    def save_config(self, need_restart: bool, need_backup: bool, cfgname: str = "", with_options=False, defer=False) -> None:
         """
         Метод записывает в конфигурационный файл новые параметры конфигурации, устанавливаемые в зависимости от списка удаляемых секций и словаря измененных/добавленных секций. 
         Параметры need_restart и need_backup указывают на необходимость перезагрузки после сохранения и создания бэкапа при сохранении соответственно. 
+        При defer=True файл записывается в фоновом потоке.
         """
         gcode = self.printer.lookup_object('gcode')
         if not self.is_data_changed() and not with_options:
@@ -653,7 +766,7 @@ class PrinterConfig:
         if need_backup:
             self.backup_config()
         try:
-            self.write(cfgname, newConfigWrapper, remain_comments)
+            self.write(cfgname, newConfigWrapper, remain_comments, defer)
         except:
             msg = _("Unable to write config file during SAVE_CONFIG")
             logging.exception(msg)
@@ -666,7 +779,14 @@ class PrinterConfig:
         return len(self.pendingSaveItems.items()) != 0 or self.status_remove_sections
 
     def old_config_wrapper(self, cfgname):
+        # Wait for earlier writes so that the file is up to date
+        self.writer.wait()
         data = self._read_config_file(cfgname)
+        # Reuse the parsed config from the last write if the file has
+        # not been changed since
+        cached = self.config_cache.pop(cfgname, None)
+        if cached is not None and cached[0] == data:
+            return cached[1], cached[2]
         data_option_comments, remain_comments = self.comments_to_option_value(data)
         configWrapper = self._build_config_wrapper(data_option_comments, cfgname, parse_includes=False)
         return configWrapper, remain_comments
@@ -703,24 +823,31 @@ class PrinterConfig:
         newConfigWrapper.fileconfig = newConfigParser
         return newConfigWrapper
 
-    def write(self, filename: str, configWrapper: ConfigWrapper, comments: dict[str, list]):
+    def write(self, filename: str, configWrapper: ConfigWrapper, comments: dict[str, list], defer=False):
         configParser = configWrapper.fileconfig
-        with open(filename, 'w') as configfile:
-            # Запись комментарией перед первой секцией 
-            configfile.write(str('\n'.join(comments['before_sections']) + '\n'))
-            for section in configParser.sections():
-                # Запись секции
-                configfile.write("[%s]\n" % section)
-                if section in comments:
-                    # Запись комментариев перед первой опцией в секции
-                    configfile.write(str('\n'.join(comments[section]) + '\n'))
-                for key, value in configParser.items(section):
-                    # Преобразование комментариев в исходный вид
-                    sval = self.comment_value_option_r.sub('#', 
-                                                           self.line_r.sub('\n\t', str(value)))
-                    configfile.write("%s: %s\n" % (key, sval))
-                # Перед очередной секций добавить пустую строку
-                configfile.write('\n')
+        configfile = io.StringIO()
+        # Запись комментарией перед первой секцией 
+        configfile.write(str('\n'.join(comments['before_sections']) + '\n'))
+        for section in configParser.sections():
+            # Запись секции
+            configfile.write("[%s]\n" % section)
+            if section in comments:
+                # Запись комментариев перед первой опцией в секции
+                configfile.write(str('\n'.join(comments[section]) + '\n'))
+            for key, value in configParser.items(section):
+                # Преобразование комментариев в исходный вид
+                sval = self.comment_value_option_r.sub('#', 
+                                                       self.line_r.sub('\n\t', str(value)))
+                configfile.write("%s: %s\n" % (key, sval))
+            # Перед очередной секций добавить пустую строку
+            configfile.write('\n')
+        data = configfile.getvalue()
+        if defer:
+            self.writer.submit(filename, data)
+        else:
+            self.writer.wait()
+            write_file_atomic(filename, data)
+        self.config_cache[filename] = (data, configWrapper, comments)
         # Обнулить измененные значения
         self.pendingSaveItems = {}
         self.haveUnsavedChanges = False
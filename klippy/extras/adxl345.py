@@ -6,6 +6,12 @@
 import logging, time, collections, multiprocessing, os
 from . import bus, bulk_sensor
 
+# Measurements are decoded and stored with numpy when it is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # ADXL345 registers
 REG_DEVID = 0x00
 REG_BW_RATE = 0x2C
@@ -30,6 +36,60 @@ SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Columnar storage of (time, accel_x, accel_y, accel_z) measurements.
+# Each column is kept in a contiguous preallocated float64 array that
+# grows by doubling up to max_samples; after that the oldest samples
+# are overwritten.
+INITIAL_STORE_SAMPLES = 1 << 16
+MAX_STORE_SAMPLES = 1 << 22
+
+class AccelSampleStore:
+    def __init__(self, max_samples=MAX_STORE_SAMPLES):
+        self.max_samples = max_samples
+        self.columns = numpy.empty(
+            (4, min(INITIAL_STORE_SAMPLES, max_samples)))
+        self.count = self.next_pos = 0
+        self.dropped = 0
+    def _grow(self, need):
+        size = self.columns.shape[1]
+        while size < need:
+            size *= 2
+        columns = numpy.empty((4, min(size, self.max_samples)))
+        columns[:, :self.count] = self.columns[:, :self.count]
+        self.columns = columns
+    def append(self, samples):
+        # Add an array with one (time, x, y, z) row per sample
+        count = len(samples)
+        if not count:
+            return
+        size = self.columns.shape[1]
+        if self.count + count > size and size < self.max_samples:
+            self._grow(self.count + count)
+            size = self.columns.shape[1]
+        if count > size:
+            self.dropped += count - size
+            samples = samples[count - size:]
+            count = size
+        columns = self.columns
+        pos = self.next_pos
+        first = min(count, size - pos)
+        columns[:, pos:pos + first] = samples[:first].T
+        columns[:, :count - first] = samples[first:].T
+        self.next_pos = (pos + count) % size
+        self.dropped += max(0, self.count + count - size)
+        self.count = min(self.count + count, size)
+    def get_samples(self):
+        # Samples in time order; this is a view of the store unless
+        # old samples were overwritten
+        columns = self.columns
+        if self.count < columns.shape[1] or not self.next_pos:
+            return columns[:, :self.count].T
+        pos = self.next_pos
+        return numpy.concatenate((columns[:, pos:], columns[:, :pos]),
+                                 axis=1).T
+    def get_dropped(self):
+        return self.dropped
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
     def __init__(self, printer):
@@ -39,20 +99,31 @@ class AccelQueryHelper:
         self.request_start_time = self.request_end_time = print_time
         self.msgs = []
         self.samples = []
+        self.store = None
+        if numpy is not None:
+            self.store = AccelSampleStore()
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
         toolhead.wait_moves()
         self.is_finished = True
+        if self.store is not None and self.store.get_dropped():
+            logging.info("Accelerometer sample store dropped %d samples",
+                         self.store.get_dropped())
     def handle_batch(self, msg):
         if self.is_finished:
             return False
+        if self.store is not None:
+            self.store.append(msg['data'])
+            return True
         if len(self.msgs) >= 10000:
             # Avoid filling up memory with too many samples
             return False
         self.msgs.append(msg)
         return True
     def has_valid_samples(self):
+        if self.store is not None:
+            return len(self.get_samples()) > 0
         for msg in self.msgs:
             data = msg['data']
             first_sample_time = data[0][0]
@@ -70,6 +141,14 @@ class AccelQueryHelper:
             return True
         return False
     def get_samples(self):
+        if self.store is not None:
+            # Returns a (time, x, y, z) array view of the requested range
+            samples = self.store.get_samples()
+            times = samples[:, 0]
+            start = numpy.searchsorted(times, self.request_start_time, 'left')
+            end = numpy.searchsorted(times, self.request_end_time, 'right')
+            self.samples = samples[start:end]
+            return self.samples
         if not self.msgs:
             return self.samples
         total = sum([len(m['data']) for m in self.msgs])
@@ -85,16 +164,20 @@ class AccelQueryHelper:
                 count += 1
         del samples[count:]
         return self.samples
-    def write_to_file(self, filename):
+    def write_to_file(self, filename, file_format='csv'):
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
+            samples = self.get_samples()
+            if file_format == 'npy':
+                with open(filename, "wb") as f:
+                    numpy.save(f, numpy.asarray(samples, dtype=numpy.float64))
+                return
             f = open(filename, "w")
             f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
             for t, accel_x, accel_y, accel_z in samples:
                 f.write("%.6f,%.6f,%.6f,%.6f\n" % (
                     t, accel_x, accel_y, accel_z))
@@ -103,6 +186,19 @@ class AccelQueryHelper:
         write_proc.daemon = True
         write_proc.start()
 
+# Raw measurements can be written as text (csv) or as a numpy array of
+# (time, accel_x, accel_y, accel_z) rows (npy)
+RAW_DATA_FORMATS = ['csv', 'npy']
+
+def get_raw_data_format(gcmd):
+    file_format = gcmd.get("FORMAT", "csv").lower()
+    if file_format not in RAW_DATA_FORMATS:
+        raise gcmd.error("Unsupported FORMAT '%s', must be one of: %s"
+                         % (file_format, ", ".join(RAW_DATA_FORMATS)))
+    if file_format == 'npy' and numpy is None:
+        raise gcmd.error("FORMAT=npy requires the numpy module")
+    return file_format
+
 # Helper class for G-Code commands
 class AccelCommandHelper:
     def __init__(self, config, chip):
@@ -142,15 +238,17 @@ class AccelCommandHelper:
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        file_format = get_raw_data_format(gcmd)
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s.%s" % (self.base_name, name, file_format)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
-        bg_client.write_to_file(filename)
+            filename = "/tmp/%s-%s-%s.%s" % (self.base_name, self.name, name,
+                                             file_format)
+        bg_client.write_to_file(filename, file_format)
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
     cmd_ACCELEROMETER_QUERY_help = _("Query accelerometer for the current values")
@@ -159,7 +257,7 @@ class AccelCommandHelper:
         self.printer.lookup_object('toolhead').dwell(1.)
         aclient.finish_measurements()
         values = aclient.get_samples()
-        if not values:
+        if not len(values):
             raise gcmd.error("No accelerometer measurements found")
         _, accel_x, accel_y, accel_z = values[-1]
         gcmd.respond_info("accelerometer values (x, y, z): %.6f, %.6f, %.6f"
@@ -184,6 +282,34 @@ def read_axes_map(config, scale_x, scale_y, scale_z):
         raise config.error("Invalid axes_map parameter")
     return [am[a.strip()] for a in axes_map]
 
+# Scale and reorder raw (time, x, y, z) chip readings
+def convert_raw_samples(axes_map, samples):
+    (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = axes_map
+    for i, (ptime, rx, ry, rz) in enumerate(samples):
+        raw_xyz = (rx, ry, rz)
+        samples[i] = (round(ptime, 6), round(raw_xyz[x_pos] * x_scale, 6),
+                      round(raw_xyz[y_pos] * y_scale, 6),
+                      round(raw_xyz[z_pos] * z_scale, 6))
+
+# Build a (time, x, y, z) array from sample times and raw chip readings
+def build_sample_array(axes_map, ptimes, raw_xyz):
+    samples = numpy.empty((len(ptimes), 4))
+    samples[:, 0] = ptimes
+    for i, (pos, scale) in enumerate(axes_map):
+        numpy.multiply(raw_xyz[pos], scale, out=samples[:, i + 1])
+    return numpy.round(samples, 6, out=samples)
+
+# Read a batch of samples from chips that report signed x, y, z values
+def pull_xyz_samples(ffreader, axes_map):
+    if numpy is None:
+        samples = ffreader.pull_samples()
+        convert_raw_samples(axes_map, samples)
+        return samples
+    ptimes, values = ffreader.pull_sample_arrays(numpy)
+    if ptimes is None:
+        return []
+    return build_sample_array(axes_map, ptimes, values.T)
+
 BATCH_UPDATES = 0.100
 
 # Printer class that controls ADXL345 chip
@@ -240,6 +366,8 @@ class ADXL345:
         aqh = AccelQueryHelper(self.printer)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
+    def add_client(self, client_cb):
+        self.batch_bulk.add_client(client_cb)
     # Measurement decoding
     def _convert_samples(self, samples):
         (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
@@ -259,6 +387,20 @@ class ADXL345:
             samples[count] = (round(ptime, 6), x, y, z)
             count += 1
         del samples[count:]
+    def _convert_sample_array(self, ptimes, values):
+        values = values.astype(numpy.int32)
+        xlow, ylow, zlow, xzhigh, yzhigh = values.T
+        valid = (yzhigh & 0x80) == 0
+        self.last_error_count += len(valid) - int(numpy.count_nonzero(valid))
+        if not valid.all():
+            ptimes, xlow, ylow, zlow, xzhigh, yzhigh = (
+                ptimes[valid], xlow[valid], ylow[valid], zlow[valid],
+                xzhigh[valid], yzhigh[valid])
+        rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
+        ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
+        rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
+              - ((yzhigh & 0x40) << 7))
+        return build_sample_array(self.axes_map, ptimes, (rx, ry, rz))
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ADXL345 device ID prevents treating
@@ -291,9 +433,15 @@ class ADXL345:
         self.ffreader.note_end()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
-        if not samples:
+        if numpy is None:
+            samples = self.ffreader.pull_samples()
+            self._convert_samples(samples)
+        else:
+            ptimes, values = self.ffreader.pull_sample_arrays(numpy)
+            if ptimes is None:
+                return {}
+            samples = self._convert_sample_array(ptimes, values)
+        if not len(samples):
             return {}
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.ffreader.get_last_overflows()}
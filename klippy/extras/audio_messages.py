@@ -1,6 +1,42 @@
-import os, logging, pathlib
+import os, logging, pathlib, subprocess, threading, queue
 import locales
 
+# Clips are played by a worker thread so that the reactor never waits
+# for aplay.  A clip that is already waiting to be played is not queued
+# a second time.
+class AudioPlayer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+    def play(self, path):
+        with self.lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+        self.queue.put(path)
+    def stop(self):
+        # Play any queued clips and then exit the worker thread
+        self.queue.put(None)
+    def _run(self):
+        while 1:
+            path = self.queue.get()
+            if path is None:
+                return
+            with self.lock:
+                self.pending.discard(path)
+            try:
+                res = subprocess.call(["aplay", "-q", path],
+                                      stdin=subprocess.DEVNULL)
+            except OSError:
+                logging.exception("Unable to run aplay")
+                continue
+            if res:
+                logging.info("aplay %s exited with code %d", path, res)
+
 class AudioMessages:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -8,49 +44,54 @@ class AudioMessages:
         self.audio_path = os.path.join(klipperpath, "audio_messages")
         self.audio_files = [file for file in os.listdir(self.audio_path) if os.path.isfile(os.path.join(self.audio_path, file))]
         self.audio_files.sort()
-        self.audio_collection = {"begin_print" : self.audio_files[0], 
+        self.audio_collection = {"begin_print" : self.audio_files[0],
                                  "end_print" : self.audio_files[1],
                                  "error" : self.audio_files[2],
                                  "hello" : self.audio_files[3],
                                  "poweroff" : self.audio_files[4]}
         self.print_stats = self.printer.load_object(config, 'print_stats')
-        self.reactor = self.printer.get_reactor()
-        self.timer = None
+        self.player = AudioPlayer()
         self.state = ""
         self.state_mass = ["interrupt","paused","cancelled","complete","error"]
         self.printer.register_event_handler("klippy:error", self._handle_error)
         self.printer.register_event_handler("klippy:shutdown", self._handle_shutdown)
         self.printer.register_event_handler("klippy:firmware_restart", self._handle_restart)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self.player.stop)
         self.printer.register_event_handler("klippy:ready",
                                             self._handle_ready)
-        
-        
+        for state in ["printing"] + self.state_mass:
+            self.printer.register_event_handler(
+                "print_stats:" + state,
+                (lambda s=state: self._handle_print_state(s)))
+
+    def play(self, name):
+        self.player.play(os.path.join(self.audio_path,
+                                      self.audio_collection[name]))
+
     def _handle_ready(self):
-        os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["hello"])))
+        self.play("hello")
         self.printer.register_event_handler("gcode:command_error", self._handle_error)
-        self.timer = self.reactor.register_timer(self._audio_control, self.reactor.NOW)
-    
+
     def _handle_error(self):
         logging.info("error %s" % (self.audio_collection["error"]))
-        os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["error"])))
+        self.play("error")
     def _handle_shutdown(self):
         logging.info("shutdown %s" % (self.audio_collection["poweroff"]))
-        os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["poweroff"])))
+        self.play("poweroff")
     def _handle_restart(self):
         logging.info("restart %s" % (self.audio_collection["poweroff"]))
-        os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["poweroff"])))
-        
-    def _audio_control(self, eventtime):
-        now_print_state = self.print_stats.get_status(eventtime)['state']
+        self.play("poweroff")
+
+    def _handle_print_state(self, now_print_state):
         if now_print_state != self.state:
             if now_print_state == "printing":
-                os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["begin_print"])))
+                self.play("begin_print")
             elif now_print_state == "complete":
-                os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["end_print"])))
+                self.play("end_print")
             elif now_print_state == "error":
-                os.system("aplay %s" % (os.path.join(self.audio_path, self.audio_collection["error"])))
+                self.play("error")
         self.state = now_print_state
-        return eventtime + .1
-    
+
 def load_config(config):
     return AudioMessages(config)
@@ -237,6 +237,13 @@ class BedMesh:
                         _("Mesh Leveling: Error splitting move "))
         self.last_position[:] = newpos
         
+    def get_status_version(self, eventtime=None):
+        # Profile dicts are replaced (not modified) when they change
+        return (self.z_mesh, self.pmgr.get_current_profile(),
+                self.pmgr.get_profiles(), self.pmgr.get_unsaved_profiles(),
+                self.bmc.group_bed_mesh_len, self.bmc.group_current_mesh,
+                self.bmc.is_preheating, self.bmc.is_calibrating)
+
     def get_status(self, eventtime=None):
         status = {
             "profile_name": "",
@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import logging, threading, struct, json
+import webhooks
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -36,6 +37,7 @@ class BatchBulkHelper:
         self.batch_timer = None
         self.client_cbs = []
         self.webhooks_start_resp = {}
+        self.encoded_msg = self.encoded_batch = None
     # Periodic batch processing
     def _start(self):
         if self.is_started:
@@ -54,6 +56,7 @@ class BatchBulkHelper:
         self.batch_timer = reactor.register_timer(self._proc_batch, waketime)
     def _stop(self):
         del self.client_cbs[:]
+        self.encoded_msg = self.encoded_batch = None
         self.printer.get_reactor().unregister_timer(self.batch_timer)
         self.batch_timer = None
         if not self.is_started:
@@ -68,6 +71,7 @@ class BatchBulkHelper:
             # New client started while in process of stopping
             self._start()
     def _proc_batch(self, eventtime):
+        self.encoded_msg = self.encoded_batch = None
         try:
             msg = self.batch_cb(eventtime)
         except self.printer.command_error as e:
@@ -89,9 +93,15 @@ class BatchBulkHelper:
     def add_client(self, client_cb):
         self.client_cbs.append(client_cb)
         self._start()
+    def get_encoded_batch(self, msg):
+        # Each batch is encoded once and shared by all API clients
+        if msg is not self.encoded_msg:
+            self.encoded_msg = msg
+            self.encoded_batch = webhooks.json_dumps(msg)
+        return self.encoded_batch
     # Webhooks registration
     def _add_api_client(self, web_request):
-        whbatch = BatchWebhooksClient(web_request)
+        whbatch = BatchWebhooksClient(web_request, self)
         self.add_client(whbatch.handle_batch)
         web_request.send(self.webhooks_start_resp)
     def add_mux_endpoint(self, path, key, value, webhooks_start_resp):
@@ -101,15 +111,23 @@ class BatchBulkHelper:
 
 # A webhooks wrapper for use by BatchBulkHelper
 class BatchWebhooksClient:
-    def __init__(self, web_request):
+    def __init__(self, web_request, batch_bulk):
         self.cconn = web_request.get_client_connection()
-        self.template = web_request.get_dict('response_template', {})
+        self.batch_bulk = batch_bulk
+        # Batches are sent as the response template with the (already
+        # encoded) batch as its 'params'
+        template = dict(web_request.get_dict('response_template', {}))
+        template.pop('params', None)
+        prefix = json.dumps(template, separators=(',', ':'))[:-1]
+        if template:
+            prefix += ','
+        self.prefix = (prefix + '"params":').encode()
     def handle_batch(self, msg):
         if self.cconn.is_closed():
             return False
-        tmp = dict(self.template)
-        tmp['params'] = msg
-        self.cconn.send(tmp)
+        encoded = self.batch_bulk.get_encoded_batch(msg)
+        # Batches are dropped while the client is not keeping up
+        self.cconn.send_encoded((self.prefix, encoded, b"}"), droppable=True)
         return True
 
 # Helper class to store incoming messages in a queue
@@ -119,10 +137,10 @@ class BulkDataQueue:
         self.lock = threading.Lock()
         self.raw_samples = []
         # Register callback with mcu
-        mcu.register_response(self._handle_data, msg_name, oid)
-    def _handle_data(self, params):
+        mcu.register_response(self._handle_data, msg_name, oid, batch=True)
+    def _handle_data(self, batch):
         with self.lock:
-            self.raw_samples.append(params)
+            self.raw_samples.extend(batch)
     def pull_queue(self):
         with self.lock:
             raw_samples = self.raw_samples
@@ -206,6 +224,7 @@ class FixedFreqReader:
     def __init__(self, mcu, chip_clock_smooth, unpack_fmt):
         self.mcu = mcu
         self.clock_sync = ClockSyncRegression(mcu, chip_clock_smooth)
+        self.unpack_fmt = unpack_fmt
         unpack = struct.Struct(unpack_fmt)
         self.unpack_from = unpack.unpack_from
         self.bytes_per_sample = unpack.size
@@ -294,4 +313,49 @@ class FixedFreqReader:
                 count += 1
         self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
         del samples[count:]
-        return samples
\ No newline at end of file
+        return samples
+    # Convert sensor_bulk_data responses into numpy arrays.  Returns an
+    # array of sample times and a 2d array with one row of unpacked
+    # values per sample (or None, None if no samples are available).
+    # Only formats using a single field type (eg, "<hhh") are supported.
+    def pull_sample_arrays(self, np):
+        # Query MCU for sample timing and update clock synchronization
+        self._update_clock()
+        # Pull sensor_bulk_data messages from local queue
+        raw_samples = self.bulk_queue.pull_queue()
+        if not raw_samples:
+            return None, None
+        last_sequence = self.last_sequence
+        time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
+        bytes_per_sample = self.bytes_per_sample
+        samples_per_block = self.samples_per_block
+        # Sequence and sample count of each message
+        seqs = np.array([p['sequence'] for p in raw_samples], dtype=np.int64)
+        seq_diff = (seqs - last_sequence) & 0xffff
+        seq_diff -= (seq_diff & 0x8000) << 1
+        seqs = last_sequence + seq_diff
+        datas = [p['data'] for p in raw_samples]
+        counts = np.array([len(d) // bytes_per_sample for d in datas])
+        total = int(counts.sum())
+        if not total:
+            return None, None
+        data = b"".join([d[:c * bytes_per_sample]
+                         for d, c in zip(datas, counts.tolist())])
+        # Calculate the time of every sample
+        first_index = np.cumsum(counts) - counts
+        msg_cdiff = np.repeat(seqs * samples_per_block - chip_base
+                              - first_index, counts)
+        ptimes = time_base + (msg_cdiff + np.arange(total)) * inv_freq
+        self.clock_sync.set_last_chip_clock(
+            int(seqs[-1]) * samples_per_block + int(counts[-1]) - 1)
+        values = np.frombuffer(data, dtype=self._get_sample_dtype(np))
+        return ptimes, values.reshape(total, -1)
+    def _get_sample_dtype(self, np):
+        fmt = self.unpack_fmt
+        byteorder = '='
+        if fmt[:1] in '<>=!@':
+            byteorder, fmt = fmt[0].replace('!', '>').replace('@', '='), fmt[1:]
+        if len(set(fmt)) != 1:
+            raise ValueError("Unsupported sample format %s"
+                             % (self.unpack_fmt,))
+        return np.dtype(byteorder + fmt[0])
\ No newline at end of file
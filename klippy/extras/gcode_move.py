@@ -146,9 +146,10 @@ class GCodeMove:
         params = gcmd.get_command_parameters()
         ignore_limit = False
         try:
+            move_params = gcmd.get_move_parameters()
             for pos, axis in enumerate('XYZ'):
-                if axis in params:
-                    v = float(params[axis])
+                if axis in move_params:
+                    v = move_params[axis]
                     if not self.absolute_coord:
                         # value relative to position of last move
                         if v < 0:
@@ -163,17 +164,17 @@ class GCodeMove:
                               raise gcmd.error(_("Has active magnet probe. Take off it manually"))
                         # value relative to base coordinate position
                         self.last_position[pos] = v + self.base_position[pos]                
-            if 'E' in params:
-                self.last_param_e = float(params['E'])
-                v = float(params['E']) * self.extrude_factor
+            if 'E' in move_params:
+                self.last_param_e = move_params['E']
+                v = move_params['E'] * self.extrude_factor
                 if not self.absolute_coord or not self.absolute_extrude:
                     # value relative to position of last move
                     self.last_position[3] += v
                 else:
                     # value relative to base coordinate position
                     self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
+            if 'F' in move_params:
+                gcode_speed = move_params['F']
                 if gcode_speed <= 0.:
                     raise gcmd.error(_("Invalid speed in '%s'")
                                      % (gcmd.get_commandline(),))
@@ -1,5 +1,5 @@
-import gettext, pathlib, os
 import logging
+import locales
 
 
 class Locale:
@@ -8,14 +8,7 @@ class Locale:
         webhooks = self.printer.lookup_object('webhooks')
         
         self.currnetLang = config.get('lang', None)
-        klipperpath = pathlib.Path(__file__).parent.parent.resolve()
-        self.lang_path = os.path.join(klipperpath, "locales")
-        self.lang_list = [d for d in os.listdir(self.lang_path) if not os.path.isfile(os.path.join(self.lang_path, d))]
-        self.lang_list.sort()
-        self.langs = {}
-        for lng in self.lang_list:
-                self.langs[lng] = gettext.translation('Klipper', localedir=self.lang_path, languages=[lng], fallback=True)
-        logging.info(str(klipperpath))
+        self.lang_list = locales.get_languages()
         logging.info(str(self.lang_list))
         printer.register_event_handler("klippy:connect", self._handle_ready)
         webhooks.register_endpoint("locale/set_lang",
@@ -27,9 +20,9 @@ class Locale:
               
     def _handle_ready(self):
         if self.currnetLang is None or self.currnetLang not in self.lang_list:
-            gettext.translation('Klipper', localedir=self.lang_path, languages=["en"], fallback=True).install()
+            locales.get_translation("en").install()
         else:
-            gettext.translation('Klipper', localedir=self.lang_path, languages=[self.currnetLang], fallback=True).install()
+            locales.get_translation(self.currnetLang).install()
         
     def _handle_set_lang(self, web_request):
         lang = web_request.get_str('lang')
@@ -48,7 +41,7 @@ class Locale:
         logging.info(f"Using lang {lang}")
         self.currnetLang = lang
         try:
-            self.langs[lang].install()
+            locales.get_translation(lang).install()
             logging.info(f"Install lang {lang}")
             self.rewrite_locale(lang)
         except:
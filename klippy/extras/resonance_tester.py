@@ -5,19 +5,109 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 import math, os, time
-from matplotlib.figure import Figure
 from . import adxl345, shaper_calibrate
 import matplotlib
 matplotlib.rcParams.update({'figure.autolayout': True})
 matplotlib.use('Agg')
-import matplotlib.pyplot, matplotlib.dates, matplotlib.font_manager
-import matplotlib.ticker
+import matplotlib.pyplot, matplotlib.font_manager, matplotlib.ticker
 from textwrap import wrap
 import locales
 import re
 
 MAX_TITLE_LENGTH=65
 
+######################################################################
+# Graph rendering
+######################################################################
+
+# Graphs are rendered in a shaper calibration background process (see
+# ShaperCalibrate.background_process_exec) so that the reactor does not
+# stall while matplotlib draws and encodes the PNG file.  matplotlib is
+# imported when this module is loaded, so the forked renderers inherit
+# it rather than importing it again for every graph.
+
+def plot_compare_frequency(datas, lognames, max_freq, axis):
+    fig, ax = matplotlib.pyplot.subplots()
+    ax.set_title(_("Frequency responses comparison"))
+    ax.set_xlabel(_("Frequency (Hz)"))
+    ax.set_ylabel(_("Power spectral density"))
+
+    for data, logname in zip(datas, lognames):
+        freqs = data.freq_bins
+        psd = data.get_psd(axis)[freqs <= max_freq]
+        freqs = freqs[freqs <= max_freq]
+        ax.plot(freqs, psd, label="\n".join(wrap(logname, 60)), alpha=0.6)
+
+    ax.xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
+    ax.yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
+    ax.grid(which='major', color='grey')
+    ax.grid(which='minor', color='lightgrey')
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+    ax.legend(loc='best', prop=fontP)
+    fig.tight_layout()
+    return fig
+
+def plot_freq_response(name, calibration_data, shapers,
+                       selected_shaper, max_freq):
+    freqs = calibration_data.freq_bins
+    psd = calibration_data.psd_sum[freqs <= max_freq]
+    px = calibration_data.psd_x[freqs <= max_freq]
+    py = calibration_data.psd_y[freqs <= max_freq]
+    pz = calibration_data.psd_z[freqs <= max_freq]
+    freqs = freqs[freqs <= max_freq]
+
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+
+    fig, ax = matplotlib.pyplot.subplots()
+    ax.set_xlabel(_("Frequency, Hz"))
+    ax.set_xlim([0, max_freq])
+    ax.set_ylabel(_("Power spectral density"))
+
+    ax.plot(freqs, psd, label='X+Y+Z', color='purple')
+    ax.plot(freqs, px, label='X', color='red')
+    ax.plot(freqs, py, label='Y', color='green')
+    ax.plot(freqs, pz, label='Z', color='blue')
+
+    title = _("Frequency response and shapers (%s)") % (name.split('/').pop())
+    ax.set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    ax.xaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(5))
+    ax.yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
+    ax.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
+    ax.grid(which='major', color='grey')
+    ax.grid(which='minor', color='lightgrey')
+
+    ax2 = ax.twinx()
+    ax2.set_ylabel(_("Shaper vibration reduction (ratio)"))
+    for shaper in shapers:
+        label = _("%s (%.1f Hz, vibr=%.1f%%, sm~=%.2f, accel<=%.f)") % (
+                shaper.name.upper(), shaper.freq,
+                shaper.vibrs * 100., shaper.smoothing,
+                round(shaper.max_accel / 100.) * 100.)
+        linestyle = 'dotted'
+        if shaper.name == selected_shaper:
+            linestyle = 'dashdot'
+        ax2.plot(freqs[:len(shaper.vals)], shaper.vals, label=label, linestyle=linestyle)
+    ax.plot(freqs[:len(shaper.vals)], psd[:len(shaper.vals)] * selected_shaper.vals,
+            label=_("After\nshaper"), color='cyan')
+    # A hack to add a human-readable shaper recommendation to legend
+    ax2.plot([], [], ' ',
+            label=_("Recommended shaper: %s") % (selected_shaper.name.upper()))
+
+    ax.legend(loc='upper left', prop=fontP)
+    ax2.legend(loc='upper right', prop=fontP)
+
+    fig.tight_layout()
+    return fig
+
+def render_graph(plot_func, args, output):
+    fig = plot_func(*args)
+    fig.set_size_inches(8, 6)
+    fig.savefig(output)
+    matplotlib.pyplot.close(fig)
+    return output
+
 def _parse_axis(gcmd, raw_axis):
     if raw_axis is None:
         return None
@@ -298,7 +388,7 @@ class ResonanceTester:
           self.stop_shaper[0] = True
 
     def _run_test(self, gcmd, axes, helper, raw_name_suffix=None,
-                  accel_chips=None, test_point=None):
+                  accel_chips=None, test_point=None, raw_format='csv'):
         toolhead = self.printer.lookup_object('toolhead')
         calibration_data = {axis: None for axis in axes}
         self.generator.prepare_test(gcmd)
@@ -318,11 +408,13 @@ class ResonanceTester:
                 if accel_chips is None:
                     for chip_axis, chip in self.accel_chips:
                         if axis.matches(chip_axis):
-                            aclient = chip.start_internal_client()
+                            aclient = self._start_client(chip, helper,
+                                                         raw_name_suffix)
                             raw_values.append((chip_axis, aclient, chip.name))
                 else:
                     for chip in accel_chips:
-                        aclient = chip.start_internal_client()
+                        aclient = self._start_client(chip, helper,
+                                                     raw_name_suffix)
                         raw_values.append((axis, aclient, chip.name))
 
                 # Generate moves
@@ -338,8 +430,9 @@ class ResonanceTester:
                         raw_name = self.get_filename(
                                 'raw_data', raw_name_suffix, axis,
                                 point if len(test_points) > 1 else None,
-                                chip_name if accel_chips is not None else None,)
-                        aclient.write_to_file(raw_name)
+                                chip_name if accel_chips is not None else None,
+                                ext=raw_format)
+                        aclient.write_to_file(raw_name, raw_format)
                         gcmd.respond_info(
                                 "Writing raw accelerometer data to "
                                 "%s file" % (raw_name,))
@@ -357,6 +450,12 @@ class ResonanceTester:
                         calibration_data[axis].add_data(new_data)
         return calibration_data
 
+    def _start_client(self, chip, helper, raw_name_suffix):
+        if helper is not None and raw_name_suffix is None:
+            # Only the frequency response is needed, so it is calculated
+            # while the test runs instead of storing all the samples
+            return helper.start_psd_client(chip)
+        return chip.start_internal_client()
     def _parse_chips(self, accel_chips):
         parsed_chips = []
         for chip_name in accel_chips.split(','):
@@ -384,33 +483,13 @@ class ResonanceTester:
                                                 helper, None, belts[belt]['data'])
           gcmd.respond_info(
                   _("Resonances data written to %s file") % (csv_name,))
-        fig: Figure = self.plot_compare_frequency([belts['left']['data'], belts['right']['data']], [_("Left belt"), _("Right belt")], plot_freq, 'all')
-        fig.set_size_inches(8, 6)
         belt_tension_path = os.path.join("/tmp/", csv_name.rpartition('/')[2].replace('.csv', '.png'))
-        fig.savefig(belt_tension_path)
-
-    def plot_compare_frequency(self, datas, lognames, max_freq, axis):
-      fig, ax = matplotlib.pyplot.subplots()
-      ax.set_title(_("Frequency responses comparison"))
-      ax.set_xlabel(_("Frequency (Hz)"))
-      ax.set_ylabel(_("Power spectral density"))
-
-      for data, logname in zip(datas, lognames):
-          freqs = data.freq_bins
-          psd = data.get_psd(axis)[freqs <= max_freq]
-          freqs = freqs[freqs <= max_freq]
-          ax.plot(freqs, psd, label="\n".join(wrap(logname, 60)), alpha=0.6)
-
-      ax.xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
-      ax.yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
-      ax.grid(which='major', color='grey')
-      ax.grid(which='minor', color='lightgrey')
-      fontP = matplotlib.font_manager.FontProperties()
-      fontP.set_size('x-small')
-      ax.legend(loc='best', prop=fontP)
-      fig.tight_layout()
-      return fig
-    
+        helper.background_process_exec(render_graph, (
+            plot_compare_frequency,
+            ([belts['left']['data'], belts['right']['data']],
+             [_("Left belt"), _("Right belt")], plot_freq, 'all'),
+            belt_tension_path))
+
     cmd_TEST_RESONANCES_help = _("Runs the resonance test for a specifed axis")
     def cmd_TEST_RESONANCES(self, gcmd):
         # Parse parameters
@@ -439,6 +518,7 @@ class ResonanceTester:
             raise gcmd.error(_("Invalid NAME parameter"))
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = adxl345.get_raw_data_format(gcmd) if raw_output else 'csv'
 
         # Setup calculation of resonances
         if csv_output:
@@ -449,7 +529,8 @@ class ResonanceTester:
         data = self._run_test(
                 gcmd, [axis], helper,
                 raw_name_suffix=name_suffix if raw_output else None,
-                accel_chips=accel_chips, test_point=test_point)[axis]
+                accel_chips=accel_chips, test_point=test_point,
+                raw_format=raw_format)[axis]
         if csv_output:
             csv_name = self.save_calibration_data(
                     'resonances', name_suffix, helper, axis, data,
@@ -488,19 +569,23 @@ class ResonanceTester:
             return
         configfile = self.printer.lookup_object('configfile')
         for axis in calibrate_axes:
-            axis_name = axis.get_name()
             gcmd.respond_info(
                     _("Calculating the best input shaper parameters for %s axis")
-                    % (axis_name,))
+                    % (axis.get_name(),))
             calibration_data[axis].normalize_to_frequencies()
-            systime = self.printer.get_reactor().monotonic()
-            toolhead = self.printer.lookup_object('toolhead')
-            toolhead_info = toolhead.get_status(systime)
-            scv = toolhead_info['square_corner_velocity']
-            max_freq = self._get_max_calibration_freq()
-            best_shaper, all_shapers = helper.find_best_shaper(
-                    calibration_data[axis], max_smoothing=max_smoothing,
-                    scv=scv, max_freq=max_freq, logger=gcmd.respond_info)
+        systime = self.printer.get_reactor().monotonic()
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead_info = toolhead.get_status(systime)
+        scv = toolhead_info['square_corner_velocity']
+        max_freq = self._get_max_calibration_freq()
+        # All axes are fitted together in parallel background processes
+        fitted_shapers = helper.find_best_shapers(
+                [calibration_data[axis] for axis in calibrate_axes],
+                max_smoothing=max_smoothing, scv=scv, max_freq=max_freq)
+        for axis, (best_shaper, all_shapers) in zip(calibrate_axes,
+                                                    fitted_shapers):
+            axis_name = axis.get_name()
+            helper.report_fitted_shapers(all_shapers, gcmd.respond_info)
             gcmd.respond_info(
                     _("Recommended shaper_type_%s = %s, shaper_freq_%s = %.1f Hz")
                     % (axis_name, best_shaper.name,
@@ -515,17 +600,29 @@ class ResonanceTester:
                     calibration_data[axis], all_shapers, max_freq=max_freq)
             gcmd.respond_info(
                     _("Shaper calibration data written to %s file") % (csv_name,))
-            fig: Figure = self.plot_freq_response(csv_name, calibration_data[axis], all_shapers,
-                                best_shaper, max_freq)
-            fig.set_size_inches(8, 6)
             shaper_path = os.path.join("/tmp/", csv_name.rpartition('/')[2].replace('.csv', '.png'))
-            fig.savefig(shaper_path)
+            shaper_path = helper.background_process_exec(render_graph, (
+                plot_freq_response,
+                (csv_name, calibration_data[axis], all_shapers,
+                 best_shaper, max_freq),
+                shaper_path))
             self.load_shaper_graph([shaper_path[1:]])
         gcmd.respond_info(
             _("The SAVE_CONFIG command will update the printer config file\n"
             "with these parameters and restart the printer."))
         self.is_shaping = False
     
+    def get_status_version(self, eventtime):
+        # The graph lists only change when their directories do
+        dir_mtimes = []
+        for dirname in ["/tmp/", self.shaper_graphs_dir]:
+            try:
+                dir_mtimes.append(os.stat(dirname).st_mtime_ns)
+            except OSError:
+                dir_mtimes.append(None)
+        return (tuple(dir_mtimes), self.active_belt_tension,
+                self.active_shaper_graph, self.is_shaping)
+
     def get_status(self, eventtime):
         return {
                   'saved': self.get_saved_shaper_graphs(),
@@ -631,70 +728,17 @@ class ResonanceTester:
         renamed_path = f"\"{self.shaper_graphs_dir}/{args[0].rpartition('/')[2]}\"" # Поскольку в dir не хватает только имени
         os.system(f"mv {renamed_path} \"{self.shaper_graphs_dir}/{args[1]}\"")
 
-    def plot_freq_response(self, name: str, calibration_data, shapers,
-                       selected_shaper, max_freq):
-        freqs = calibration_data.freq_bins
-        psd = calibration_data.psd_sum[freqs <= max_freq]
-        px = calibration_data.psd_x[freqs <= max_freq]
-        py = calibration_data.psd_y[freqs <= max_freq]
-        pz = calibration_data.psd_z[freqs <= max_freq]
-        freqs = freqs[freqs <= max_freq]
-
-        fontP = matplotlib.font_manager.FontProperties()
-        fontP.set_size('x-small')
-
-        fig, ax = matplotlib.pyplot.subplots()
-        ax.set_xlabel(_("Frequency, Hz"))
-        ax.set_xlim([0, max_freq])
-        ax.set_ylabel(_("Power spectral density"))
-
-        ax.plot(freqs, psd, label='X+Y+Z', color='purple')
-        ax.plot(freqs, px, label='X', color='red')
-        ax.plot(freqs, py, label='Y', color='green')
-        ax.plot(freqs, pz, label='Z', color='blue')
-
-        title = _("Frequency response and shapers (%s)") % (name.split('/').pop())
-        ax.set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
-        ax.xaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(5))
-        ax.yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
-        ax.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
-        ax.grid(which='major', color='grey')
-        ax.grid(which='minor', color='lightgrey')
-
-        ax2 = ax.twinx()
-        ax2.set_ylabel(_("Shaper vibration reduction (ratio)"))
-        for shaper in shapers:
-            label = _("%s (%.1f Hz, vibr=%.1f%%, sm~=%.2f, accel<=%.f)") % (
-                    shaper.name.upper(), shaper.freq,
-                    shaper.vibrs * 100., shaper.smoothing,
-                    round(shaper.max_accel / 100.) * 100.)
-            linestyle = 'dotted'
-            if shaper.name == selected_shaper:
-                linestyle = 'dashdot'
-            ax2.plot(freqs[:len(shaper.vals)], shaper.vals, label=label, linestyle=linestyle)
-        ax.plot(freqs[:len(shaper.vals)], psd[:len(shaper.vals)] * selected_shaper.vals,
-                label=_("After\nshaper"), color='cyan')
-        # A hack to add a human-readable shaper recommendation to legend
-        ax2.plot([], [], ' ',
-                label=_("Recommended shaper: %s") % (selected_shaper.name.upper()))
-
-        ax.legend(loc='upper left', prop=fontP)
-        ax2.legend(loc='upper right', prop=fontP)
-
-        fig.tight_layout()
-        return fig
-
     cmd_MEASURE_AXES_NOISE_help = (
         _("Measures noise of all enabled accelerometer chips"))
     def cmd_MEASURE_AXES_NOISE(self, gcmd):
         meas_time = gcmd.get_float("MEAS_TIME", 2.)
         self.printer.lookup_object('homing').run_G28_if_unhomed()
-        raw_values = [(chip_axis, chip.start_internal_client())
+        helper = shaper_calibrate.ShaperCalibrate(self.printer)
+        raw_values = [(chip_axis, helper.start_psd_client(chip))
                       for chip_axis, chip in self.accel_chips]
         self.printer.lookup_object('toolhead').dwell(meas_time)
         for chip_axis, aclient in raw_values:
             aclient.finish_measurements()
-        helper = shaper_calibrate.ShaperCalibrate(self.printer)
         for chip_axis, aclient in raw_values:
             if not aclient.has_valid_samples():
                 raise gcmd.error(
@@ -710,14 +754,17 @@ class ResonanceTester:
     def is_valid_name_suffix(self, name_suffix):
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
-    def get_filename(self, base, name_suffix, axis=None, point=None):
+    def get_filename(self, base, name_suffix, axis=None, point=None,
+                     chip_name=None, ext='csv'):
         name = base
         if axis:
             name += '_' + axis.get_name()
+        if chip_name:
+            name += '_' + chip_name.replace(" ", "_")
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + "." + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data,
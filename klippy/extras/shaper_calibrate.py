@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import collections, importlib, logging, math, multiprocessing, traceback
+import multiprocessing.connection
 import locales
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
 
@@ -16,6 +17,15 @@ TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Just some empirically chosen value which produces good projections
+# for max_accel without much smoothing
+TARGET_SMOOTHING = 0.12
+
+# Maximum number of background processes used to fit shapers
+MAX_CALC_PROCESSES = 4
+# Number of test frequencies evaluated at once by fit_shaper
+FIT_FREQS_CHUNK = 64
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
@@ -57,6 +67,123 @@ class CalibrationData:
     def get_psd(self, axis='all'):
         return self._psd_map[axis]
 
+######################################################################
+# Streaming frequency response calculation
+######################################################################
+
+# Samples received during the last STREAM_HOLD_TIME seconds are only
+# windowed once the end of the test is known
+STREAM_HOLD_TIME = 1.
+# Capture time used to estimate the sampling frequency (and thus the
+# window size) before the first window is processed
+STREAM_RATE_TIME = 1.
+
+# Streaming version of ShaperCalibrate.calc_freq_response().  Samples
+# are consumed as batches arrive from the sensor and only the running
+# sums of the windowed periodograms are kept, so memory use does not
+# depend on the test length.
+class PSDAccumulator:
+    def __init__(self, helper, printer):
+        self.helper = helper
+        self.numpy = np = helper.numpy
+        self.printer = printer
+        self.is_finished = False
+        print_time = printer.lookup_object('toolhead').get_last_move_time()
+        self.request_start_time = self.request_end_time = print_time
+        # Samples not yet consumed by windows (starting at sample 'base')
+        self.samples = np.empty((0, 4))
+        self.base = self.next_window = self.count = 0
+        self.first_time = self.last_time = None
+        self.nfft = self.window = self.psd_sums = None
+        self.num_windows = 0
+    def _get_sampling_freq(self):
+        return self.count / (self.last_time - self.first_time)
+    def _setup_window(self):
+        np = self.numpy
+        fs = self._get_sampling_freq()
+        # Round up to the nearest power of 2 for faster FFT
+        self.nfft = 1 << int(fs * WINDOW_T_SEC - 1).bit_length()
+        self.window = np.kaiser(self.nfft, 6.)
+        self.psd_sums = np.zeros((self.nfft // 2 + 1, 3))
+    def _process_windows(self, end):
+        # Accumulate all windows that end before sample 'end'
+        np = self.numpy
+        nfft = self.nfft
+        overlap = nfft // 2
+        step = nfft - overlap
+        if end - self.next_window < nfft:
+            return
+        n_windows = (end - self.next_window - nfft) // step + 1
+        start = self.next_window - self.base
+        data = self.samples[start:start + (n_windows - 1) * step + nfft]
+        for axis in range(3):
+            x = self.helper._split_into_windows(data[:, axis + 1],
+                                                nfft, overlap)
+            # First detrend, then apply windowing function
+            x = self.window[:, None] * (x - np.mean(x, axis=0))
+            result = np.fft.rfft(x, n=nfft, axis=0)
+            self.psd_sums[:, axis] += (np.conjugate(result)
+                                       * result).real.sum(axis=1)
+        self.num_windows += n_windows
+        self.next_window += n_windows * step
+        # Samples before the next window are no longer needed
+        self.samples = self.samples[self.next_window - self.base:]
+        self.base = self.next_window
+    def handle_batch(self, msg):
+        if self.is_finished:
+            return False
+        np = self.numpy
+        samples = np.asarray(msg['data'], dtype=np.float64)
+        if self.first_time is None and len(samples):
+            samples = samples[samples[:, 0] >= self.request_start_time]
+            if len(samples):
+                self.first_time = samples[0, 0]
+        if not len(samples):
+            return True
+        self.samples = np.concatenate((self.samples, samples))
+        self.count += len(samples)
+        self.last_time = samples[-1, 0]
+        if self.nfft is None:
+            if self.last_time - self.first_time < STREAM_RATE_TIME:
+                return True
+            self._setup_window()
+        hold = int(self._get_sampling_freq() * STREAM_HOLD_TIME)
+        self._process_windows(self.count - hold)
+        return True
+    def finish_measurements(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        self.request_end_time = toolhead.get_last_move_time()
+        toolhead.wait_moves()
+        self.is_finished = True
+        if not len(self.samples):
+            return
+        # Drop samples measured after the end of the test
+        keep = int(self.numpy.searchsorted(
+            self.samples[:, 0], self.request_end_time, 'right'))
+        self.count -= len(self.samples) - keep
+        self.samples = self.samples[:keep]
+        if keep:
+            self.last_time = self.samples[-1, 0]
+    def has_valid_samples(self):
+        return self.count > 0
+    def get_calibration_data(self):
+        np = self.numpy
+        if not self.count or self.last_time <= self.first_time:
+            return None
+        if self.nfft is None:
+            self._setup_window()
+        if self.count <= self.nfft:
+            return None
+        self._process_windows(self.count)
+        # Same scaling as ShaperCalibrate._psd()
+        fs = self._get_sampling_freq()
+        scale = 1.0 / (self.window**2).sum()
+        psd = self.psd_sums * (scale / fs / self.num_windows)
+        psd[1:-1,:] *= 2.
+        freqs = np.fft.rfftfreq(self.nfft, 1. / fs)
+        px, py, pz = [psd[:, axis].copy() for axis in range(3)]
+        return CalibrationData(freqs, px+py+pz, px, py, pz)
+
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
@@ -74,40 +201,74 @@ class ShaperCalibrate:
                     "docs/Measuring_Resonances.md for more details)."))
 
     def background_process_exec(self, method, args):
-        if self.printer is None:
-            return method(*args)
-        import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
+        return self.background_process_exec_all(method, [args])[0]
+
+    def background_process_exec_all(self, method, args_list):
+        # Evaluate method(*args) for every entry of args_list in a small
+        # pool of background processes and return the results in order
+        max_procs = max(1, min(MAX_CALC_PROCESSES,
+                               multiprocessing.cpu_count()))
+        if self.printer is None and (len(args_list) <= 1 or max_procs == 1):
+            return [method(*args) for args in args_list]
+        results = [None] * len(args_list)
+        pending = list(enumerate(args_list))
+        running = {}
+        def start_process(index, args):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            def wrapper():
+                if self.printer is not None:
+                    import queuelogger
+                    queuelogger.clear_bg_logging()
+                try:
+                    res = method(*args)
+                except:
+                    child_conn.send((True, traceback.format_exc()))
+                    child_conn.close()
+                    return
+                child_conn.send((False, res))
                 child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
+            calc_proc = multiprocessing.Process(target=wrapper)
+            calc_proc.daemon = True
+            calc_proc.start()
+            running[parent_conn] = (index, calc_proc)
+        def stop_processes():
+            for parent_conn, (index, calc_proc) in running.items():
+                calc_proc.terminate()
+                parent_conn.close()
+            running.clear()
+        # Start processes to perform the calculations and wait for them
+        if self.printer is not None:
+            reactor = self.printer.get_reactor()
+            gcode = self.printer.lookup_object("gcode")
+            eventtime = last_report_time = reactor.monotonic()
+        while pending or running:
+            while pending and len(running) < max_procs:
+                start_process(*pending.pop(0))
+            for parent_conn in list(running.keys()):
+                if not parent_conn.poll():
+                    continue
+                index, calc_proc = running.pop(parent_conn)
+                try:
+                    is_err, res = parent_conn.recv()
+                except EOFError:
+                    is_err, res = True, "Background process exited"
+                calc_proc.join()
+                parent_conn.close()
+                if is_err:
+                    stop_processes()
+                    raise self.error(
+                        _("Error in remote calculation: %s") % (res,))
+                results[index] = res
+            if not running:
+                continue
+            if self.printer is None:
+                multiprocessing.connection.wait(list(running.keys()))
+                continue
             if eventtime > last_report_time + 5.:
                 last_report_time = eventtime
                 gcode.respond_info(_("Wait for calculations.."), log=False)
             eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error(_("Error in remote calculation: %s") % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        return results
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -156,10 +317,12 @@ class ShaperCalibrate:
         if isinstance(raw_values, np.ndarray):
             data = raw_values
         else:
+            # Accelerometer clients storing samples with numpy return
+            # an array view here, which is used without copying
             samples = raw_values.get_samples()
-            if not samples:
+            if not len(samples):
                 return None
-            data = np.array(samples)
+            data = np.asarray(samples)
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
@@ -176,40 +339,61 @@ class ShaperCalibrate:
         fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
+    def start_psd_client(self, chip):
+        # Calculate the frequency response while the chip is measuring
+        client = PSDAccumulator(self, self.printer)
+        chip.add_client(client.handle_batch)
+        return client
+
     def process_accelerometer_data(self, data):
-        calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+        if isinstance(data, PSDAccumulator):
+            calibration_data = data.get_calibration_data()
+        else:
+            calibration_data = self.background_process_exec(
+                    self.calc_freq_response, (data,))
         if calibration_data is None:
             raise self.error(
                     _("Internal error processing accelerometer data %s" )% (data,))
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
-    def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
+    def _get_shapers(self, shaper_cfg, test_freqs, damping_ratio):
+        # Pulse amplitudes (A) and times (T) with one row per test frequency
         np = self.numpy
-
-        A, T = np.array(shaper[0]), np.array(shaper[1])
-        inv_D = 1. / A.sum()
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        return A, T
+
+    def _estimate_shapers(self, A, T, test_damping_ratio, test_freqs):
+        # Vibration reduction of each shaper (row of A, T) at test_freqs
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
 
         omega = 2. * math.pi * test_freqs
         damping = test_damping_ratio * omega
         omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
-        W = A * np.exp(np.outer(-damping, (T[-1] - T)))
-        S = W * np.sin(np.outer(omega_d, T))
-        C = W * np.cos(np.outer(omega_d, T))
-        return np.sqrt(S.sum(axis=1)**2 + C.sum(axis=1)**2) * inv_D
-
-    def _estimate_remaining_vibrations(self, shaper, test_damping_ratio,
-                                       freq_bins, psd):
-        vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
-        # The input shaper can only reduce the amplitude of vibrations by
-        # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
-        # threshold can be igonred
-        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
-        remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
-        all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
-        return (remaining_vibrations / all_vibrations, vals)
+        W = A[:, None, :] * np.exp(
+                -damping[None, :, None] * (T[:, -1:] - T)[:, None, :])
+        phase = omega_d[None, :, None] * T[:, None, :]
+        S = (W * np.sin(phase)).sum(axis=-1)
+        C = (W * np.cos(phase)).sum(axis=-1)
+        return np.sqrt(S**2 + C**2) * inv_D[:, None]
+
+    def _get_shapers_smoothing(self, A, T, scv):
+        # Both offsets used by _get_shaper_smoothing() are linear in accel;
+        # returns the (offset_90 at zero accel, offset_90 per accel,
+        # offset_180 per accel) coefficients for each shaper
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
+        ts = (A * T).sum(axis=-1) * inv_D
+        dt = T - ts[:, None]
+        A_90 = np.where(dt >= 0., A, 0.)
+        offset_90 = (A_90 * dt).sum(axis=-1) * scv * inv_D * math.sqrt(2.)
+        accel_90 = (A_90 * dt**2).sum(axis=-1) * .5 * inv_D * math.sqrt(2.)
+        accel_180 = (A * dt**2).sum(axis=-1) * .5 * inv_D
+        return offset_90, accel_90, accel_180
 
     def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
         half_accel = accel * .5
@@ -256,37 +440,62 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= max_freq]
         freq_bins = freq_bins[freq_bins <= max_freq]
 
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
+        # Evaluate all test frequencies at once, starting from the highest
+        test_freqs = test_freqs[::-1]
+        A, T = self._get_shapers(shaper_cfg, test_freqs, damping_ratio)
+        offset_90, accel_90, accel_180 = self._get_shapers_smoothing(A, T, scv)
+        shaper_smoothing = np.maximum(offset_90 + accel_90 * 5000.,
+                                      accel_180 * 5000.)
+        # Solve smoothing(max_accel) == TARGET_SMOOTHING for each shaper
+        with np.errstate(divide='ignore'):
+            max_accels = np.minimum((TARGET_SMOOTHING - offset_90) / accel_90,
+                                    TARGET_SMOOTHING / accel_180)
+        max_accels[offset_90 + accel_90 * 1e-9 > TARGET_SMOOTHING] = 0.
+        # Frequencies below the first one (after the highest frequency)
+        # that produces too much smoothing are not considered
+        num_freqs = len(test_freqs)
+        too_smooth = False
+        if max_smoothing:
+            over = np.nonzero(shaper_smoothing[1:] > max_smoothing)[0]
+            if len(over):
+                num_freqs = int(over[0]) + 1
+                too_smooth = True
+
+        # The input shaper can only reduce the amplitude of vibrations by
+        # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
+        # threshold can be igonred
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        shaper_vibrations = np.zeros(shape=(num_freqs,))
+        shaper_vals = np.zeros(shape=(num_freqs, freq_bins.shape[0]))
+        for i in range(0, num_freqs, FIT_FREQS_CHUNK):
+            j = min(i + FIT_FREQS_CHUNK, num_freqs)
             # Exact damping ratio of the printer is unknown, pessimizing
             # remaining vibrations over possible damping values
             for dr in test_damping_ratios:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
-                # The current frequency is better for the shaper.
-                best_res = results[-1]
+                vals = self._estimate_shapers(A[i:j], T[i:j], dr, freq_bins)
+                vibrations = np.maximum(
+                        vals * psd - vibr_threshold, 0).sum(axis=-1)
+                np.maximum(shaper_vals[i:j], vals, out=shaper_vals[i:j])
+                np.maximum(shaper_vibrations[i:j],
+                           vibrations / all_vibrations,
+                           out=shaper_vibrations[i:j])
+        # The score trying to minimize vibrations, but also accounting
+        # the growth of smoothing. The formula itself does not have any
+        # special meaning, it simply shows good results on real user data
+        shaper_smoothing = shaper_smoothing[:num_freqs]
+        shaper_scores = shaper_smoothing * (shaper_vibrations**1.5 +
+                                            shaper_vibrations * .2 + .01)
+        results = [CalibrationResult(
+                        name=shaper_cfg.name, freq=test_freqs[i],
+                        vals=shaper_vals[i], vibrs=shaper_vibrations[i],
+                        smoothing=shaper_smoothing[i], score=shaper_scores[i],
+                        max_accel=max_accels[i])
+                   for i in range(num_freqs)]
+        # The best frequency for the shaper
+        best_res = results[int(np.argmin(shaper_vibrations))]
+        if too_smooth:
+            return best_res
         # Try to find an 'optimal' shapper configuration: the one that is not
         # much worse than the 'best' one, but gives much less smoothing
         selected = best_res
@@ -314,9 +523,6 @@ class ShaperCalibrate:
         return left
 
     def find_shaper_max_accel(self, shaper, scv):
-        # Just some empirically chosen value which produces good projections
-        # for max_accel without much smoothing
-        TARGET_SMOOTHING = 0.12
         max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
             shaper, test_accel, scv) <= TARGET_SMOOTHING)
         return max_accel
@@ -325,31 +531,53 @@ class ShaperCalibrate:
                          damping_ratio=None, scv=None, shaper_freqs=None,
                          max_smoothing=None, test_damping_ratios=None,
                          max_freq=None, logger=None):
-        best_shaper = None
-        all_shapers = []
+        best_shaper, all_shapers = self.find_best_shapers(
+                [calibration_data], shapers, damping_ratio, scv, shaper_freqs,
+                max_smoothing, test_damping_ratios, max_freq)[0]
+        if logger is not None:
+            self.report_fitted_shapers(all_shapers, logger)
+        return best_shaper, all_shapers
+
+    def find_best_shapers(self, calibration_datas, shapers=None,
+                          damping_ratio=None, scv=None, shaper_freqs=None,
+                          max_smoothing=None, test_damping_ratios=None,
+                          max_freq=None):
+        # Fit all shapers for all calibration data sets in parallel and
+        # return a (best_shaper, all_shapers) tuple for each data set
         shapers = shapers or AUTOTUNE_SHAPERS
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in shapers:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
-            if logger is not None:
-                logger(_("Fitted shaper '%s' frequency = %.1f Hz "
-                       "(vibrations = %.1f%%, smoothing ~= %.3f)") % (
-                           shaper.name, shaper.freq, shaper.vibrs * 100.,
-                           shaper.smoothing))
-                logger(_("To avoid too much smoothing with '%s', suggested "
-                       "max_accel <= %.0f mm/sec^2") % (
-                           shaper.name, round(shaper.max_accel / 100.) * 100.))
-            all_shapers.append(shaper)
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in shapers]
+        fitted = self.background_process_exec_all(self.fit_shaper, [
+            (shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
+             scv, max_smoothing, test_damping_ratios, max_freq)
+            for calibration_data in calibration_datas
+            for shaper_cfg in shaper_cfgs])
+        results = []
+        for i in range(len(calibration_datas)):
+            all_shapers = fitted[i * len(shaper_cfgs):(i+1) * len(shaper_cfgs)]
+            results.append((self._select_best_shaper(all_shapers), all_shapers))
+        return results
+
+    def _select_best_shaper(self, all_shapers):
+        best_shaper = None
+        for shaper in all_shapers:
             if (best_shaper is None or shaper.score * 1.2 < best_shaper.score or
                     (shaper.score * 1.05 < best_shaper.score and
                         shaper.smoothing * 1.1 < best_shaper.smoothing)):
                 # Either the shaper significantly improves the score (by 20%),
                 # or it improves the score and smoothing (by 5% and 10% resp.)
                 best_shaper = shaper
-        return best_shaper, all_shapers
+        return best_shaper
+
+    def report_fitted_shapers(self, all_shapers, logger):
+        for shaper in all_shapers:
+            logger(_("Fitted shaper '%s' frequency = %.1f Hz "
+                   "(vibrations = %.1f%%, smoothing ~= %.3f)") % (
+                       shaper.name, shaper.freq, shaper.vibrs * 100.,
+                       shaper.smoothing))
+            logger(_("To avoid too much smoothing with '%s', suggested "
+                   "max_accel <= %.0f mm/sec^2") % (
+                       shaper.name, round(shaper.max_accel / 100.) * 100.))
 
     def save_params(self, configfile, axis, shaper_name, shaper_freq):
         if axis == 'xy':
@@ -3,8 +3,76 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, time, logging
+import os, time, logging, collections, struct, math
 import locales
+
+# Binary stats file format: a header followed by records.  A 'K' record
+# lists the stat names ('\n' separated) of the 'S' records that follow
+# it.  An 'S' record holds eventtime, system time, the active flag and
+# one double per stat name (NaN for values that are not numbers).
+STATS_FILE_MAGIC = b"KLSTATS1"
+STATS_FILE_MAX_SIZE = 32 * 1024 * 1024
+STATS_FLUSH_COUNT = 10
+
+def parse_stats(msgs):
+    # Convert "[prefix:] name=value ..." stats messages to names/values
+    keys = []
+    values = []
+    for msg in msgs:
+        prefix = ""
+        for part in msg.split():
+            if '=' not in part:
+                prefix = part
+                continue
+            name, val = part.split('=', 1)
+            try:
+                val = float(val) if '.' in val else int(val)
+            except ValueError:
+                pass
+            keys.append(prefix + name)
+            values.append(val)
+    return tuple(keys), tuple(values)
+
+class StatsFile:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.keys = None
+        self.pending = 0
+    def _open(self):
+        if self.file is not None and self.file.tell() < STATS_FILE_MAX_SIZE:
+            return
+        if self.file is not None:
+            self.file.close()
+            os.replace(self.filename, self.filename + ".1")
+        self.file = open(self.filename, "ab")
+        if not self.file.tell():
+            self.file.write(STATS_FILE_MAGIC)
+        self.keys = None
+    def write(self, eventtime, systime, is_active, keys, values):
+        try:
+            self._open()
+            f = self.file
+            if keys != self.keys:
+                data = "\n".join(keys).encode()
+                f.write(b"K" + struct.pack("<I", len(data)) + data)
+                self.keys = keys
+            values = [v if isinstance(v, (int, float)) else math.nan
+                      for v in values]
+            f.write(b"S" + struct.pack("<ddB%dd" % (len(values),), eventtime,
+                                       systime, is_active, *values))
+            self.pending += 1
+            if self.pending >= STATS_FLUSH_COUNT:
+                f.flush()
+                self.pending = 0
+        except (IOError, OSError):
+            logging.exception("Unable to write stats file %s", self.filename)
+            self.close()
+            self.filename = None
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 class PrinterSysStats:
     def __init__(self, config):
         printer = config.get_printer()
@@ -17,6 +85,18 @@ class PrinterSysStats:
         except:
             pass
         printer.register_event_handler("klippy:disconnect", self._disconnect)
+        # Optional reactor callback profiling
+        self.profiler = None
+        if config.getboolean('reactor_profile', False):
+            slow_time = config.getfloat('slow_callback_time', 0.100, above=0.)
+            self.profiler = printer.get_reactor().enable_profiling(slow_time)
+        webhooks = printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/callback_stats",
+                                   self._handle_callback_stats)
+    def _handle_callback_stats(self, web_request):
+        if self.profiler is None:
+            raise web_request.error(_("Reactor profiling is not enabled"))
+        web_request.send(self.profiler.get_stats())
     def _disconnect(self):
         if self.mem_file is not None:
             self.mem_file.close()
@@ -43,6 +123,9 @@ class PrinterSysStats:
                         break
             except:
                 pass
+        if self.profiler is not None:
+            msg = "%s callback_max=%.3f slow_callbacks=%d" % (
+                msg, self.profiler.get_period_max(), self.profiler.slow_count)
         return (False, msg)
     def get_status(self, eventtime):
         return {'sysload': self.last_load_avg,
@@ -55,19 +138,56 @@ class PrinterStats:
         reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
+        # Recent stats as (eventtime, systime, is_active, keys, values)
+        self.history = collections.deque(
+            maxlen=config.getint('stats_history', 1800, minval=1))
+        self.last_keys = ()
+        self.stats_file = None
+        filename = config.get('stats_file', None)
+        if filename is not None:
+            self.stats_file = StatsFile(os.path.expanduser(filename))
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self.handle_disconnect)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("statistics/query", self._handle_query)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
+    def handle_disconnect(self):
+        if self.stats_file is not None:
+            self.stats_file.close()
     def generate_stats(self, eventtime):
         stats = [cb(eventtime) for cb in self.stats_cb]
-        # if max([s[0] for s in stats]):
-        #     logging.info("Stats %.1f: %s", eventtime,
-        #                  ' '.join([s[1] for s in stats]))
+        is_active = max([s[0] for s in stats] + [False])
+        keys, values = parse_stats([s[1] for s in stats])
+        if keys == self.last_keys:
+            # Share the names tuple between records
+            keys = self.last_keys
+        self.last_keys = keys
+        systime = time.time()
+        self.history.append((eventtime, systime, is_active, keys, values))
+        if (is_active and self.stats_file is not None
+            and self.stats_file.filename is not None):
+            self.stats_file.write(eventtime, systime, is_active, keys, values)
         return eventtime + 1.
+    def _handle_query(self, web_request):
+        start_time = web_request.get_float('start_time', 0.)
+        end_time = web_request.get_float('end_time', float('inf'))
+        names = web_request.get('keys', None, types=(list,))
+        records = []
+        for eventtime, systime, is_active, keys, values in self.history:
+            if eventtime < start_time or eventtime > end_time:
+                continue
+            stats = dict(zip(keys, values))
+            if names is not None:
+                stats = {k: stats[k] for k in names if k in stats}
+            records.append({'eventtime': eventtime, 'systime': systime,
+                            'active': bool(is_active), 'stats': stats})
+        web_request.send({'records': records})
 
 def load_config(config):
     config.get_printer().add_object('system_stats', PrinterSysStats(config))
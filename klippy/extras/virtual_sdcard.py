@@ -3,13 +3,17 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging, io
+import os, logging, io, time, collections
 import pathlib
 import re
 import locales
 import subprocess
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 READ_SIZE = 1024 * 1024  # 1 MiB 
+DEFAULT_WORK_READ_SIZE = 64 * 1024
+# Directories modified this recently are rescanned on the next lookup,
+# as coarse filesystem timestamps (eg, vfat) may hide later changes
+DIR_MTIME_SLACK = 2.
 SUPPORTED_SLICERS = {
   "PrusaSlicer": {
     "name": 
@@ -23,13 +27,22 @@ SUPPORTED_SLICERS = {
         r"Slic3r\sPrusa\sEdition\s(.*)\son",
         r"Slic3r\s(\d.*)\son"}
     ,
-    "filament_type": {r";\sfilament_type\s=\s(%S)"}
+    "filament_type": {r";\sfilament_type\s=\s(%S)"},
+    "nozzle_temp":
+        {r";\stemperature\s=\s(%S)",
+        r";\snozzle_temperature\s=\s(%S)"},
+    "bed_temp":
+        {r";\sbed_temperature\s=\s(%S)",
+        r";\shot_plate_temp\s=\s(%S)"},
+    "estimated_time":
+        {r";\sestimated\sprinting\stime\s\(normal\smode\)\s=\s(%S)"}
   },
   "Cura": {
     "name": 
         {r"Cura_SteamEngine\s(.*)"}
     ,
-    "filament_type": {r";Filament\stype\s=\s(%S)"}
+    "filament_type": {r";Filament\stype\s=\s(%S)"},
+    "estimated_time": {r";TIME:(%S)"}
   },
   "Simplify3D": {
     "name": 
@@ -54,12 +67,273 @@ SUPPORTED_SLICERS = {
   }
 }
 
-def regex_find_string(pattern: str, data: str):
-    pattern = pattern.replace(r"(%S)", r"(.*)")
-    match = re.search(pattern, data)
-    if match:
-        return match.group(1).strip('"')
-    return None
+# Slicer metadata extraction.  The slicer is identified from the start
+# of the file and its other fields are then searched for from the end
+# of the file backwards (where most slicers store their settings),
+# falling back to the header.  Reading stops as soon as every field is
+# found.
+METADATA_BLOCK_SIZE = 64 * 1024
+METADATA_CACHE_SIZE = 32
+
+def _compile_slicers():
+    slicers = []
+    for slicer, defs in SUPPORTED_SLICERS.items():
+        names = [re.compile(r) for r in defs['name']]
+        fields = {key: [re.compile(r.replace(r"(%S)", r"(.*)"))
+                        for r in regs]
+                  for key, regs in defs.items() if key != 'name'}
+        slicers.append((slicer, names, fields))
+    return slicers
+SLICER_PATTERNS = _compile_slicers()
+
+# Return the text of the complete lines in f[start:end] one block at a
+# time, either in file order or from the end backwards
+def _read_text_blocks(f, start, end, backward=False):
+    carry = b""
+    pos = end if backward else start
+    while start < pos if backward else pos < end:
+        if backward:
+            count = min(METADATA_BLOCK_SIZE, pos - start)
+            pos -= count
+            f.seek(pos)
+            data = f.read(count) + carry
+            nl = data.find(b'\n') if pos > start else -1
+            carry, data = data[:nl+1], data[nl+1:]
+        else:
+            f.seek(pos)
+            data = carry + f.read(min(METADATA_BLOCK_SIZE, end - pos))
+            pos += METADATA_BLOCK_SIZE
+            nl = data.rfind(b'\n') if pos < end else len(data)
+            data, carry = data[:nl+1], data[nl+1:]
+        if data:
+            yield data.decode('utf-8', 'replace')
+
+def read_slicer_metadata(f, size):
+    header = []
+    for text in _read_text_blocks(f, 0, min(size, READ_SIZE)):
+        header.append(text)
+        for slicer, names, fields in SLICER_PATTERNS:
+            if any(r.search(text) for r in names):
+                break
+        else:
+            continue
+        break
+    else:
+        return {}
+    metadata = {'slicer': slicer}
+    missing = dict(fields)
+    def search(text):
+        for key, regs in list(missing.items()):
+            for r in regs:
+                match = r.search(text)
+                if match:
+                    metadata[key] = match.group(1).strip('"')
+                    del missing[key]
+                    break
+        return not missing
+    footer = _read_text_blocks(f, max(0, size - READ_SIZE), size,
+                               backward=True)
+    if not any(search(text) for text in footer):
+        any(search(text) for text in header)
+    return metadata
+
+# Streaming reader for g-code files opened in binary mode.  Each call
+# to read_lines() reads the next chunk of the file and returns an
+# iterator of (next_position, line) tuples for the complete lines in
+# it, where next_position is the byte offset just past the line's
+# newline.  The chunk is decoded once and byte offsets are only taken
+# from the raw data when it contains multi-byte characters.
+class GCodeFileReader:
+    def __init__(self, fileobj, read_size=DEFAULT_WORK_READ_SIZE):
+        self.file = fileobj
+        self.read_size = read_size
+        self.position = 0
+        self.partial = b""
+    def seek(self, pos):
+        self.file.seek(pos)
+        self.position = pos
+        self.partial = b""
+    def read_lines(self):
+        while 1:
+            data = self.file.read(self.read_size)
+            if not data:
+                # End of file (an unterminated last line is discarded)
+                return None
+            if self.partial:
+                data = self.partial + data
+            end = data.rfind(b'\n')
+            if end < 0:
+                self.partial = data
+                continue
+            self.partial = data[end+1:]
+            data = data[:end]
+            text = data.decode('utf-8', 'replace')
+            lines = text.split('\n')
+            if len(text) == len(data):
+                raw_lines = lines
+            else:
+                raw_lines = data.split(b'\n')
+            pos = self.position
+            self.position += end + 1
+            return self._iter_lines(lines, raw_lines, pos)
+    def _iter_lines(self, lines, raw_lines, pos):
+        for line, raw in zip(lines, raw_lines):
+            pos += len(raw) + 1
+            yield pos, line
+
+# Start g-code details needed to resume an interrupted print, gathered
+# by a single pass over the beginning of the file when it is loaded.
+# The first G28 is taken as the reference point of the start g-code,
+# which is assumed to fit within START_GCODE_CONTEXT lines either side
+# of it - this works the same way for all slicers.  The scan runs on
+# the reactor, so it gives up after START_GCODE_SCAN_SIZE bytes (files
+# that home from a PRINT_START macro have no G28 at all).
+START_GCODE_CONTEXT = 50
+START_GCODE_SCAN_SIZE = 1024 * 1024
+class PrintResumeIndex:
+    def __init__(self):
+        self.start_lines = []
+        self.bed_temp_line = None
+    def scan(self, reader):
+        before = collections.deque(maxlen=START_GCODE_CONTEXT)
+        after = None
+        need_temp = True
+        while need_temp or after is None \
+              or len(after) < START_GCODE_CONTEXT:
+            if reader.position >= START_GCODE_SCAN_SIZE:
+                break
+            lines = reader.read_lines()
+            if lines is None:
+                break
+            for pos, line in lines:
+                if need_temp:
+                    if line.startswith('M190') or line.startswith('M109'):
+                        self.bed_temp_line = line
+                        need_temp = False
+                    elif line.find('CURRENT_LAYER=1') != -1:
+                        # No point looking for a temperature after this
+                        need_temp = False
+                if after is None:
+                    if line.startswith("G28"):
+                        after = [line]
+                    else:
+                        before.append(line)
+                elif len(after) < START_GCODE_CONTEXT:
+                    after.append(line)
+                elif not need_temp:
+                    break
+        if after is not None:
+            self.start_lines = list(before) + after
+        return self
+    def get_bed_temp(self):
+        if self.bed_temp_line is None:
+            return 0
+        return int(self.bed_temp_line.split(" ")[1][1:])
+    def get_start_gcode(self):
+        extruder_gcode = heater_bed_gcode = ""
+        exclude_gcode = []
+        extrusion_gcode = "M82"
+        for line in self.start_lines:
+            if line.startswith("M109") or line.startswith("M104"):
+                extruder_gcode = line
+            elif line.startswith("M190") or line.startswith("M140"):
+                heater_bed_gcode = line
+            elif line.startswith("M83"):
+                extrusion_gcode = line
+            elif line.startswith("EXCLUDE_OBJECT_DEFINE"):
+                exclude_gcode.append(line)
+        return extruder_gcode, heater_bed_gcode, extrusion_gcode, exclude_gcode
+
+# Cached index of the files in the gcode directory tree.  Directory
+# contents are only re-read when the directory's mtime changes.  Files
+# rewritten in place do not change the directory mtime, so the cached
+# files are re-stat'ed (without listing the directory) on each lookup.
+class GCodeFileIndex:
+    def __init__(self, root):
+        self.root = root
+        # dirs[path] = (mtime_ns or None, {name: (mtime_ns, size)},
+        #               [subdir names])
+        self.dirs = {}
+        self.dirty = True
+        self.gcode_files = {}
+        self.gcode_list = []
+    def _scan_dir(self, path):
+        st = os.stat(path)
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns:
+            self._update_files(path, entry[1])
+            return entry[1], entry[2]
+        files = {}
+        subdirs = []
+        with os.scandir(path) as it:
+            for de in it:
+                try:
+                    if de.is_dir():
+                        subdirs.append(de.name)
+                    elif de.is_file():
+                        fst = de.stat()
+                        files[de.name] = (fst.st_mtime_ns, fst.st_size)
+                except OSError:
+                    continue
+        mtime = st.st_mtime_ns
+        if time.time() - st.st_mtime < DIR_MTIME_SLACK:
+            mtime = None
+        self.dirs[path] = (mtime, files, subdirs)
+        self.dirty = True
+        return files, subdirs
+    def _update_files(self, path, files):
+        for name, info in list(files.items()):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                del files[name]
+                self.dirty = True
+                continue
+            new_info = (st.st_mtime_ns, st.st_size)
+            if new_info != info:
+                files[name] = new_info
+                self.dirty = True
+    def get_dir_files(self, path=None):
+        files = self._scan_dir(path or self.root)[0]
+        return {name: size for name, (mtime, size) in files.items()}
+    def _refresh(self):
+        seen = set()
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            try:
+                files, subdirs = self._scan_dir(path)
+            except OSError:
+                continue
+            pending.extend([os.path.join(path, d) for d in subdirs])
+        for path in list(self.dirs):
+            if path not in seen:
+                del self.dirs[path]
+                self.dirty = True
+        if not self.dirty:
+            return
+        self.dirty = False
+        gcode_files = {}
+        prefix_len = len(self.root) + 1
+        for path, (mtime, files, subdirs) in self.dirs.items():
+            for name, (fmtime, size) in files.items():
+                ext = name[name.rfind('.')+1:]
+                if ext not in VALID_GCODE_EXTS:
+                    continue
+                r_path = os.path.join(path, name)[prefix_len:]
+                gcode_files[r_path] = size
+        self.gcode_files = gcode_files
+        self.gcode_list = sorted(gcode_files.items(),
+                                 key=lambda f: f[0].lower())
+    def get_gcode_files(self):
+        self._refresh()
+        return self.gcode_files
+    def get_gcode_list(self):
+        self._refresh()
+        return self.gcode_list
 
 class VirtualSD:
     def __init__(self, config):
@@ -78,24 +352,29 @@ class VirtualSD:
         else:
           sd = os.path.join(path, 'gcodes')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
-        self.header_data = self.footer_data = None
+        self.file_index = GCodeFileIndex(self.sdcard_dirname)
+        self.file_metadata = {}
+        self.metadata_cache = {}
+        self.resume_index = None
         self.media_dirname = "/media"
         self.rebuild_choise = config.get('rebuild', "")
         stepper_z = config.getsection('stepper_z')
         self.max_z = stepper_z.getint('position_max')
         self.current_file = None
-        self.interrupted_file = None
+        self.interrupted_file = self._find_interrupted_file()
         self.show_interrupt = False
         self.watch_bed_mesh = config.getboolean('watch_bed_mesh', False)
         self.autoload_bed_mesh = config.getboolean('autoload_bed_mesh', False)
         self.last_coord = [0.0, 0.0, 0.0, 0.0]
         self.file_position = self.file_size = 0
+        self.read_size = config.getint('read_size', DEFAULT_WORK_READ_SIZE,
+                                       minval=4096)
         # Print Stat Tracking
         self.print_stats = self.printer.load_object(config, 'print_stats')
         # Work timer
         self.reactor = self.printer.get_reactor()
         self.must_pause_work = self.cmd_from_sd = False
-        self.next_file_position = 0
+        self.next_file_position = self.read_file_position = 0
         self.work_timer = None
         # Error handling
         gcode_macro = self.printer.load_object(config, 'gcode_macro')
@@ -170,29 +449,20 @@ class VirtualSD:
         return True, "sd_pos=%d" % (self.file_position,)
     def get_file_list(self, check_subdirs=False):
         if check_subdirs:
-            flist = []
-            for root, dirs, files in os.walk(
-                    self.sdcard_dirname, followlinks=True):
-                for name in files:
-                    ext = name[name.rfind('.')+1:]
-                    if ext not in VALID_GCODE_EXTS:
-                        continue
-                    full_path = os.path.join(root, name)
-                    r_path = full_path[len(self.sdcard_dirname) + 1:]
-                    size = os.path.getsize(full_path)
-                    flist.append((r_path, size))
-            return sorted(flist, key=lambda f: f[0].lower())
+            return list(self.file_index.get_gcode_list())
         else:
-            dname = self.sdcard_dirname
             try:
-                filenames = os.listdir(self.sdcard_dirname)
-                return [(fname, os.path.getsize(os.path.join(dname, fname)))
-                        for fname in sorted(filenames, key=str.lower)
-                        if not fname.startswith('.')
-                        and os.path.isfile((os.path.join(dname, fname)))]
+                files = self.file_index.get_dir_files()
+                return [(fname, files[fname])
+                        for fname in sorted(files, key=str.lower)
+                        if not fname.startswith('.')]
             except:
                 logging.exception("virtual_sdcard get_file_list")
                 raise self.gcode.error(_("Unable to get file list"))
+    def _get_file_names(self, check_subdirs=False):
+        if check_subdirs:
+            return self.file_index.get_gcode_files()
+        return {fname for fname, fsize in self.get_file_list()}
     def get_status(self, eventtime):
         return {
             'gcode_path': self.sdcard_dirname,
@@ -287,7 +557,8 @@ class VirtualSD:
             self.current_file = None
             self.print_stats.note_cancel()
         self.file_position = self.file_size = 0.
-        self.header_data = self.footer_data = None
+        self.file_metadata = {}
+        self.resume_index = None
         self.run_gcode_on_cancel()
     def run_gcode_on_cancel(self):
       pos = self.printer.lookup_object('toolhead').get_position()
@@ -309,7 +580,8 @@ class VirtualSD:
             self._remove_file()
             ####    END NEW    ####
         self.file_position = self.file_size = 0.
-        self.header_data = self.footer_data = None
+        self.file_metadata = {}
+        self.resume_index = None
         self.print_stats.reset()
         self.printer.send_event("virtual_sdcard:reset_file")
     cmd_SDCARD_RESET_FILE_help = _("Clears a loaded SD File. Stops the print if necessary")
@@ -411,16 +683,13 @@ class VirtualSD:
         raise Exception()
         
     def _load_file(self, gcmd, filename: str, file_position=0, check_subdirs=False):
-        files = self.get_file_list(check_subdirs)
-        flist = [f[0] for f in files]
-        #files_by_lower = { fname.lower(): fname for fname, fsize in files }
+        flist = self._get_file_names(check_subdirs)
         fname: str = filename
         try:
             if fname not in flist:
                 media_fname = self.find_media_file(fname)
                 name = fname.split('/').pop()
-                parent_files = self.get_file_list()
-                parent_flist = [f[0] for f in parent_files]
+                parent_flist = self._get_file_names()
                 tmp_r = re.compile('_tmp(?:[0-9]*)')
                 i = 0
                 result_name = None
@@ -440,11 +709,14 @@ class VirtualSD:
                 subprocess.check_output(f"cp \"{media_fname}\" \"{fname}\"", universal_newlines=True, shell=True, stderr=subprocess.STDOUT)  
             else:  
                 fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
+            f = io.open(fname, 'rb')
             f.seek(0, os.SEEK_END)
             fsize = f.tell()
             f.seek(0)
-            self._load_footer_data(f, fsize)
+            self._load_metadata(f, fname, fsize)
+            reader = GCodeFileReader(f, self.read_size)
+            reader.seek(0)
+            resume_index = PrintResumeIndex().scan(reader)
             f.seek(0)
         except Exception as e:
             logging.exception(f"virtual_sdcard file open: {e}")
@@ -452,32 +724,26 @@ class VirtualSD:
         gcmd.respond_raw(_("File opened:%s Size:%d") % (filename, fsize))
         gcmd.respond_raw(_("File selected"))
         self.current_file = f
+        self.resume_index = resume_index
         self.file_position = file_position
         self.file_size = fsize
         self.print_stats.set_current_file(filename)
 
-    def _load_footer_data(self, f: io.TextIOWrapper, size: int):
-      self.header_data = f.read(READ_SIZE)
-      if size > READ_SIZE * 2:
-          f.seek(size - READ_SIZE)
-          self.footer_data = f.read()
-      elif size > READ_SIZE:
-          remaining = size - READ_SIZE
-          self.footer_data = self.header_data[remaining - READ_SIZE:] + f.read()
-      else:
-          self.footer_data = self.header_data
+    def _load_metadata(self, f: io.BufferedReader, fname: str, size: int):
+        key = (fname, os.fstat(f.fileno()).st_mtime_ns, size)
+        metadata = self.metadata_cache.get(key)
+        if metadata is None:
+            metadata = read_slicer_metadata(f, size)
+            if len(self.metadata_cache) >= METADATA_CACHE_SIZE:
+                self.metadata_cache.clear()
+            self.metadata_cache[key] = metadata
+        self.file_metadata = metadata
+
+    def get_file_metadata(self):
+        return self.file_metadata
 
     def get_filament_type(self):
-        if not (self.header_data and self.footer_data):
-            return ""
-        for sliser in SUPPORTED_SLICERS:
-            for r_name in SUPPORTED_SLICERS[sliser]['name']:
-                if re.search(r_name, self.header_data):
-                    for r_filament in SUPPORTED_SLICERS[sliser]['filament_type']:
-                      ft = regex_find_string(r_filament, self.footer_data)
-                      if ft:
-                          return ft
-        return ""
+        return self.file_metadata.get('filament_type', "")
               
     def cmd_M24(self, gcmd):
         # Start/resume SD print
@@ -505,29 +771,41 @@ class VirtualSD:
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
+    def _dispatch_lines(self, lines):
+        for next_file_position, line in lines:
+            self.cmd_from_sd = True
+            self.next_file_position = next_file_position
+            self.read_file_position = next_file_position
+            yield line
+    def _note_line_done(self):
+        self.cmd_from_sd = False
+        self.file_position = self.next_file_position
+        # Stop dispatching on a pause request or a change of position
+        return (not self.must_pause_work
+                and self.next_file_position == self.read_file_position)
     def work_handler(self, eventtime):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
+        reader = GCodeFileReader(self.current_file, self.read_size)
         try:
-            self.current_file.seek(self.file_position)
+            reader.seek(self.file_position)
         except:
             logging.exception("virtual_sdcard seek")
             self.work_timer = None
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        lines = None
         error_message = None
         while not self.must_pause_work:
-            if not lines:
+            if lines is None:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    lines = reader.read_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if lines is None:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
@@ -535,26 +813,16 @@ class VirtualSD:
                     self.gcode.respond_raw(_("Done printing file"))
                     self.run_gcode_on_cancel()
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
-            self.cmd_from_sd = True
-            line = lines.pop()
-            if sys.version_info.major >= 3:
-                next_file_position = self.file_position + len(line.encode()) + 1
-            else:
-                next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
+            # Dispatch commands
             try:
-                self.gcode.run_script(line)
+                finished = self.gcode.run_script_lines(
+                    self._dispatch_lines(lines), self._note_line_done)
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -565,18 +833,18 @@ class VirtualSD:
             except:
                 logging.exception("virtual_sdcard dispatch")
                 break
-            self.cmd_from_sd = False
-            self.file_position = self.next_file_position
+            if finished:
+                lines = None
+                continue
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if self.next_file_position != self.read_file_position:
                 try:
-                    self.current_file.seek(self.file_position)
+                    reader.seek(self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
                     self.work_timer = None
                     return self.reactor.NEVER
-                lines = []
-                partial_input = ""
+                lines = None
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
@@ -602,16 +870,12 @@ class VirtualSD:
             lines = [filename, position, f"{last_pos.z}\n", f"{last_pos.x}\n", f"{last_pos.y}\n", f"{last_e}\n"]
             interrupted_file.writelines(lines)
             interrupted_file.close()
+            self.interrupted_file = os.path.relpath(file, self.sdcard_dirname)
             return
 
     def load_saved_parameters(self):
-        if os.path.isdir(self.sdcard_dirname):
-            filelist = os.listdir(self.sdcard_dirname)
-            if len(filelist) != 0:
-                for file in filelist:
-                    if file.endswith('.interrupted'):
-                        self.interrupted_file = file
-                        break
+        if self.interrupted_file is None:
+            self.interrupted_file = self._find_interrupted_file()
         file = io.open(self.sdcard_dirname + '/' + self.interrupted_file, "r")
         lines = file.readlines()
         self.current_file = lines[0].rstrip()
@@ -622,73 +886,25 @@ class VirtualSD:
         file.close()
     
 
-    def find_start_heater_bed_temp(self): 
-        lines = []
-        partial_input = ""
-        file = io.open(self.file_path(), "r", newline='')
-        file_position = 0
-        data = file.read(8192)
-        while data:
-            if not lines:
-                # Read more data
-                try:
-                    data = file.read(8192)
-                except:
-                    return 0
-                if not data:
-                    # End of file
-                    file.close()
-                    return 0
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
-                continue
-            line: str = lines.pop()
-            if line.startswith('M190') or line.startswith('M109'):
-                return int(line.split(" ")[1][1:])
-            if line.find('CURRENT_LAYER=1') != -1: # типо после данной команды дальше температуру искать нет смысла
-                return 0
-            next_file_position = file_position + len(line.encode()) + 1       
-            file_position = next_file_position
-            file.seek(file_position)
-        return 0
+    def find_start_heater_bed_temp(self):
+        if self.resume_index is None:
+            return 0
+        return self.resume_index.get_bed_temp()
 
-    # G28 означает, что подготовительные работы закончены или почти закончены -> можно номер строки выбрать в качестве опорного
-    # Будем считать, что в пределах [i - 50; i + 50] у нас вмещается весь стартовый g-код
-    # Это +- унифицированный метод, который может работать со всеми слайсерами
-    def find_start_gcode_lines(self, lines: list[str]):
-      for i, line in enumerate(lines):
-          if line.startswith("G28"):
-              return 0 if i - 50 < 0 else i - 50, len(lines) if i + 50 > len(lines) else i + 50
-    
     # Последний exclude-объект будет определяться путем дальнейшего чтения g-кода, пока не найдет команду
     # EXCLUDE_OBJECT_END NAME={name} - это будет означать, что печать прервалась, когда был активен name
-    def find_last_exclude_object(self, file: io.FileIO):
-        file_position = self.file_position
-        file.seek(file_position)
-        data: str = file.read(8192)
-        lines: list[str] = []
-        while data:
-          if not lines:
-              # Read more data
-              try:
-                  data = file.read(8192)
-              except:
-                  return ""
-              if not data:
-                  # End of file
-                  file.close()
-                  return ""
-              lines = data.split('\n')
-              lines.reverse()
-          line: str = lines.pop()
-          if line.startswith("EXCLUDE_OBJECT_END"):
-              return line.replace("EXCLUDE_OBJECT_END", "EXCLUDE_OBJECT_START")
-          next_file_position = file_position + len(line.encode()) + 1       
-          file_position = next_file_position
-          file.seek(file_position)
-        return ""
+    def find_last_exclude_object(self):
+        with io.open(self.file_path(), "rb") as file:
+            reader = GCodeFileReader(file, self.read_size)
+            reader.seek(self.file_position)
+            while 1:
+                lines = reader.read_lines()
+                if lines is None:
+                    return ""
+                for pos, line in lines:
+                    if line.startswith("EXCLUDE_OBJECT_END"):
+                        return line.replace("EXCLUDE_OBJECT_END",
+                                            "EXCLUDE_OBJECT_START")
 
     # Печать может восстановиться только если во время печати аспользуется абсолютное позиционирование - потому что ебля с определением правильных координат мне не всралась от слова совсем
     # В случае дистанции экструзии, то она может быть как абсолютной, так и относительной
@@ -696,26 +912,13 @@ class VirtualSD:
         if self.work_timer:
           self.reactor.unregister_timer(self.work_timer)
         self.print_stats.note_start()
-        file: io.FileIO = io.open(self.file_path(), "r", newline='')
-        lines: list[str] = file.readlines()
-        start, end = self.find_start_gcode_lines(lines)
-        extruder_gcode = heater_bed_gcode = exclude_start_gcode = ""
-        exclude_gcode: list[str] = []
-        extrusion_gcode = "M82"
         # Найти базовые параметры 
-        for line in lines[start:end]:
-          if line.startswith("M109") or line.startswith("M104"):
-              extruder_gcode = line
-          elif line.startswith("M190") or line.startswith("M140"):
-              heater_bed_gcode = line
-          elif line.startswith("M83"):
-              extrusion_gcode = line
-          elif line.startswith("EXCLUDE_OBJECT_DEFINE"):
-              exclude_gcode.append(line)
+        (extruder_gcode, heater_bed_gcode, extrusion_gcode,
+         exclude_gcode) = self.resume_index.get_start_gcode()
+        exclude_start_gcode = ""
         # Если у нас в g-коде используются exclude-объекты, то надо восстановить последний используемый перед прерыванием
         if exclude_gcode:
-            exclude_start_gcode = self.find_last_exclude_object(file)
-        file.close()
+            exclude_start_gcode = self.find_last_exclude_object()
         #Установка последней координаты по Z
         toolhead = self.printer.lookup_object('toolhead')
         kin_status = toolhead.get_kinematics().get_status(self.reactor.monotonic())
@@ -746,15 +949,19 @@ class VirtualSD:
             self.work_handler, self.reactor.NOW)
         return self.reactor.NEVER
 
-    def has_interrupted_file(self):
+    # The interrupted print record is only looked up on disk at startup
+    # (or when it is needed and not known); afterwards it is kept up to
+    # date by save_printing_parameters() and _remove_file() so that
+    # get_status() does not have to list the gcode directory.
+    def _find_interrupted_file(self):
         if os.path.isdir(self.sdcard_dirname):
-            filelist = os.listdir(self.sdcard_dirname)
-            if len(filelist) != 0:
-                for file in filelist:
-                    if file.endswith('.interrupted'):
-                        self.interrupted_file = file
-                        return True
-        return False
+            for file in os.listdir(self.sdcard_dirname):
+                if file.endswith('.interrupted'):
+                    return file
+        return None
+
+    def has_interrupted_file(self):
+        return self.interrupted_file is not None
 
 ####    END NEW    ####
 
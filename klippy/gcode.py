@@ -12,22 +12,39 @@ class CommandError(Exception):
 
 Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
 
+MOVE_PARAMS = frozenset('XYZEF')
+
 class GCodeCommand:
     error = CommandError
-    def __init__(self, gcode: GCodeDispatch, command: str, commandline: str, params: dict, need_ack: bool):
+    def __init__(self, gcode: GCodeDispatch, command: str, commandline: str, params: dict, need_ack: bool,
+                 move_params=None):
         self._command = command
         self._commandline = commandline
         self._params = params
         self._need_ack = need_ack
+        self._move_params = move_params
         # Method wrappers
         self.respond_info = gcode.respond_info
         self.respond_raw = gcode.respond_raw
+    def _reset(self, command, commandline, params, need_ack, move_params):
+        self._command = command
+        self._commandline = commandline
+        self._params = params
+        self._need_ack = need_ack
+        self._move_params = move_params
     def get_command(self):
         return self._command
     def get_commandline(self):
         return self._commandline
     def get_command_parameters(self) -> dict:
         return self._params
+    def get_move_parameters(self) -> dict:
+        # The X, Y, Z, E and F parameters converted to floats (raises
+        # ValueError on an invalid number)
+        if self._move_params is None:
+            self._move_params = {k: float(v) for k, v in self._params.items()
+                                 if k in MOVE_PARAMS}
+        return self._move_params
     def get_raw_command_parameters(self):
         command = self._command
         if command.startswith("M117 ") or command.startswith("M118 "):
@@ -124,7 +141,14 @@ class GCodeDispatch:
         self.async_commands = {}
         self.mux_commands = {}
         self.gcode_help = {}
-        self.status_commands = {}
+        # The command catalog is rebuilt on demand after a change, so
+        # registering many commands during config load only builds it once
+        self.commands_version = 0
+        self.status_commands = self.command_help = None
+        self.status_async_commands = []
+        # Command object reused by the move fast path (None while in use)
+        self.shared_move_gcmd = GCodeCommand(self, "", "", {}, False)
+        self.move_gcmd = self.shared_move_gcmd
         # Register commands needed before config file is loaded
         handlers = ['M110', 'M112', 'M115',
                     'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
@@ -153,7 +177,7 @@ class GCodeDispatch:
                 _("async command %s must start with 'ASYNC_' prefix") % (cmd,)) # no locale
         self.async_commands[cmd] = func
         self.gcode_help[cmd] = desc
-        self._build_status_commands()
+        self._note_commands_changed()
         
     def register_command(self, cmd, func, when_not_ready=False, desc=None):
         if func is None:
@@ -162,7 +186,7 @@ class GCodeDispatch:
                 del self.ready_gcode_handlers[cmd]
             if cmd in self.base_gcode_handlers:
                 del self.base_gcode_handlers[cmd]
-            self._build_status_commands()
+            self._note_commands_changed()
             return old_cmd
         if cmd in self.ready_gcode_handlers:
             raise self.printer.config_error(
@@ -175,7 +199,7 @@ class GCodeDispatch:
             self.base_gcode_handlers[cmd] = func
         if desc is not None:
             self.gcode_help[cmd] = desc
-        self._build_status_commands()
+        self._note_commands_changed()
     def register_mux_command(self, cmd, key, value, func, desc=None):
         prev = self.mux_commands.get(cmd)
         if prev is None:
@@ -193,12 +217,24 @@ class GCodeDispatch:
                     cmd, key, value, prev_values))
         prev_values[value] = func
     def get_command_help(self):
-        return dict(self.gcode_help)
+        # The returned dict is shared and must not be modified
+        if self.command_help is None:
+            self.command_help = dict(self.gcode_help)
+        return self.command_help
+    def get_status_version(self, eventtime):
+        return self.commands_version
+    def get_status_fragments(self):
+        return ('commands',)
     def get_status(self, eventtime):
+        if self.status_commands is None:
+            self._build_status_commands()
         return {
                 'commands': self.status_commands,
-                'async_commands': [cmd for cmd in self.async_commands]
+                'async_commands': self.status_async_commands
                 }
+    def _note_commands_changed(self):
+        self.status_commands = self.command_help = None
+        self.commands_version += 1
     def _build_status_commands(self):
         commands = {cmd: {} for cmd in self.gcode_handlers}
         commands.update({cmd: {} for cmd in self.async_commands})
@@ -206,6 +242,7 @@ class GCodeDispatch:
             if cmd in commands:
                 commands[cmd]['help'] = self.gcode_help[cmd]
         self.status_commands = commands
+        self.status_async_commands = list(self.async_commands)
     def register_output_handler(self, cb):
         self.output_callbacks.append(cb)
     def _handle_shutdown(self):
@@ -213,14 +250,14 @@ class GCodeDispatch:
             return
         self.is_printer_ready = False
         self.gcode_handlers = self.base_gcode_handlers
-        self._build_status_commands()
+        self._note_commands_changed()
         self._respond_state("Shutdown")
     def _handle_disconnect(self):
         self._respond_state("Disconnect")
     def _handle_ready(self):
         self.is_printer_ready = True
         self.gcode_handlers = self.ready_gcode_handlers
-        self._build_status_commands()
+        self._note_commands_changed()
         self._respond_state("Ready")
     
     
@@ -247,11 +284,44 @@ class GCodeDispatch:
         params = { parts[i]: parts[i+1].strip()
                     for i in range(1, numparts, 2) }
         return cmd, origline, params
-    
+    # Plain G0-G3 moves (uppercase, space separated, decimal numbers) make
+    # up most of a print file.  They are parsed without the generic regex
+    # split and their values are converted to floats only once.
+    move_r = re.compile(r'G[0-3](?: +[XYZEFIJKR][-+]?(?:[0-9]+\.?[0-9]*'
+                        r'|\.[0-9]+))* *')
+    def _parse_move(self, line):
+        origline = line = line.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        if self.move_r.fullmatch(line) is None:
+            return None
+        parts = line.split()
+        cmd = parts[0]
+        params = {'G': cmd[1:]}
+        move_params = {}
+        for part in parts[1:]:
+            param = part[0]
+            value = params[param] = part[1:]
+            move_params[param] = float(value)
+        return cmd, origline, params, move_params
+
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
-            cmd, origline, params = self.parse_command(line)
-            gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            move = self._parse_move(line)
+            gcmd = self.move_gcmd
+            if move is None:
+                cmd, origline, params = self.parse_command(line)
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
+            elif gcmd is None:
+                # The shared command object is in use by an outer command
+                cmd, origline, params, move_params = move
+                gcmd = GCodeCommand(self, cmd, origline, params, need_ack,
+                                    move_params)
+            else:
+                cmd, origline, params, move_params = move
+                gcmd._reset(cmd, origline, params, need_ack, move_params)
+                self.move_gcmd = None
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
             try:
@@ -260,6 +330,7 @@ class GCodeDispatch:
                 self._respond_error(str(e))
                 self.printer.send_event("gcode:command_error")
                 if not need_ack:
+                    self._release_move_gcmd(gcmd)
                     raise
             except:
                 msg = _('Internal error on command:"%s"') % (cmd,)
@@ -267,14 +338,32 @@ class GCodeDispatch:
                 self.printer.invoke_shutdown(msg)
                 self._respond_error(msg)
                 if not need_ack:
+                    self._release_move_gcmd(gcmd)
                     raise
             gcmd.ack()
+            self._release_move_gcmd(gcmd)
+    def _release_move_gcmd(self, gcmd):
+        # Only the shared command object is returned to the slot
+        if gcmd is self.shared_move_gcmd:
+            self.move_gcmd = gcmd
             
     def run_script_from_command(self, script):
         self._process_commands(script.split('\n'), need_ack=False)
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_script_lines(self, lines, line_cb):
+        # Run lines from an iterator while holding the mutex.  The
+        # line_cb() callback is invoked after each line and may return
+        # False to stop.  Returns True once all lines have been run, or
+        # False if stopped early by line_cb() or by a pending request.
+        mutex = self.mutex
+        with mutex:
+            for line in lines:
+                self._process_commands((line,), need_ack=False)
+                if not line_cb() or mutex.has_waiters():
+                    return False
+        return True
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -287,6 +287,13 @@ def main():
                     help="input tty name (default is /tmp/printer)")
     opts.add_option("-a", "--api-server", dest="apiserver",
                     help="api server unix domain socket filename")
+    opts.add_option("--api-send-limit", dest="api_send_limit", type="int",
+                    help="bytes queued for an api client before applying"
+                    " the send policy")
+    opts.add_option("--api-send-policy", dest="api_send_policy",
+                    type="choice", choices=["drop", "disconnect"],
+                    help="action when an api client is not reading its"
+                    " messages (drop or disconnect)")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
     opts.add_option("-v", action="store_true", dest="verbose",
@@ -305,6 +312,10 @@ def main():
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
                   'start_reason': 'startup'}
+    if options.api_send_limit is not None:
+        start_args['api_send_limit'] = options.api_send_limit
+    if options.api_send_policy is not None:
+        start_args['api_send_policy'] = options.api_send_policy
     debuglevel = logging.INFO
     if options.verbose:
         debuglevel = logging.DEBUG
@@ -1,20 +1,40 @@
 import gettext, pathlib, os, configparser, sys
 klipperpath = pathlib.Path(__file__).parent.resolve()
 lang_path = os.path.join(klipperpath, "locales")
-gettext.translation('Klipper', localedir=lang_path, languages=["en"], fallback=True).install()
+
+# Translations are loaded on first use and kept for later lookups
+translations = {}
+lang_list = None
+locale_loaded = False
+
+def get_languages():
+    global lang_list
+    if lang_list is None:
+        lang_list = sorted(d for d in os.listdir(lang_path)
+                           if not os.path.isfile(os.path.join(lang_path, d)))
+    return lang_list
+
+def get_translation(lang):
+    trans = translations.get(lang)
+    if trans is None:
+        trans = translations[lang] = gettext.translation(
+            'Klipper', localedir=lang_path, languages=[lang], fallback=True)
+    return trans
+
+get_translation("en").install()
 
 def set_locale():
+    # Only the first call reads the config file, later calls do nothing
+    global locale_loaded
+    if locale_loaded:
+        return
+    locale_loaded = True
     try:
         config_file = sys.argv[1]
         config = configparser.ConfigParser()
         config.read(config_file)
-        lang_list = [d for d in os.listdir(lang_path) if not os.path.isfile(os.path.join(lang_path, d))]
-        lang_list.sort()
-        langs = {}
-        for lng in lang_list:
-            langs[lng] = gettext.translation('Klipper', localedir=lang_path, languages=[lng], fallback=True)
         lang = config.get("locale", "lang")
-        if lang in lang_list:
-            langs[lang].install()
+        if lang in get_languages():
+            get_translation(lang).install()
     except:
-        return
\ No newline at end of file
+        return
@@ -160,6 +160,55 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate parse and encode functions for a message.  The generated
+# code handles each parameter in turn without a loop.  Integers that
+# fit in a single byte (the common case) are handled inline and
+# strings are sliced directly - other values call the parameter type.
+def compile_message(msgid, param_names):
+    env = {'msgid': msgid}
+    parse_code = ["    pos += 1"]
+    encode_code = []
+    for i, (name, t) in enumerate(param_names):
+        env['p%d' % (i,)] = t.parse
+        env['e%d' % (i,)] = t.encode
+        if t.is_dynamic_string:
+            parse_code.append("    l = s[pos]\n"
+                              "    v%d = bytes(s[pos+1:pos+l+1])\n"
+                              "    pos += l + 1" % (i,))
+        elif t.is_int:
+            parse_code.append("    v%d = s[pos]\n"
+                              "    if v%d < 0x60:\n"
+                              "        pos += 1\n"
+                              "    else:\n"
+                              "        v%d, pos = p%d(s, pos)" % (i, i, i, i))
+        else:
+            parse_code.append("    v%d, pos = p%d(s, pos)" % (i, i))
+        if t.is_int:
+            encode_code.append("    v = {0}\n"
+                               "    if -0x20 <= v < 0x60:\n"
+                               "        out.append(v & 0x7f)\n"
+                               "    else:\n"
+                               "        e%d(out, v)" % (i,))
+        else:
+            encode_code.append("    e%d(out, {0})" % (i,))
+    values = "".join(["v%d, " % (i,) for i in range(len(param_names))])
+    items = "".join(["%s: v%d, " % (repr(name), i)
+                     for i, (name, t) in enumerate(param_names)])
+    code = "\n".join(parse_code)
+    src = ["def parse(s, pos):\n%s\n    return {%s}, pos" % (code, items),
+           "def parse_tuple(s, pos):\n%s\n    return (%s), pos" % (code,
+                                                                   values),
+           "def encode(params):\n    out = [msgid]\n%s\n    return out" % (
+               "\n".join([c.format("params[%d]" % (i,))
+                          for i, c in enumerate(encode_code)]),),
+           "def encode_by_name(**params):\n    out = [msgid]\n%s\n"
+           "    return out" % ("\n".join([c.format("params[%s]" % (repr(n),))
+                                         for c, (n, t) in zip(encode_code,
+                                                              param_names)]),)]
+    exec("\n".join(src), env)
+    return (env['parse'], env['parse_tuple'],
+            env['encode'], env['encode_by_name'])
+
 class MessageFormat:
     def __init__(self, msgid, msgformat, enumerations={}):
         self.msgid = msgid
@@ -169,25 +218,11 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
-    def encode(self, params):
-        out = []
-        out.append(self.msgid)
-        for i, t in enumerate(self.param_types):
-            t.encode(out, params[i])
-        return out
-    def encode_by_name(self, **params):
-        out = []
-        out.append(self.msgid)
-        for name, t in self.param_names:
-            t.encode(out, params[name])
-        return out
-    def parse(self, s, pos):
-        pos += 1
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
+        # parse(s, pos) returns a dict of the parameters and parse_tuple()
+        # returns a tuple of them (in message format order).  encode()
+        # takes a list of parameters and encode_by_name() keyword args.
+        (self.parse, self.parse_tuple, self.encode,
+         self.encode_by_name) = compile_message(msgid, self.param_names)
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -3,18 +3,25 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq, sys, threading
+import traceback, bisect
 import greenlet
 import chelper, util
 import locales 
 locales.set_locale()
 _NOW = 0.
 _NEVER = 9999999999999999.
+# Rebuild the timer heap once it holds this many stale entries (and
+# more stale entries than active timers)
+TIMER_COMPACT_COUNT = 64
 
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        # Sequence number of the timer's queue entry (0 if it has no
+        # entry, None once unregistered)
+        self.seq = 0
 
 class ReactorCompletion:
     class sentinel: pass
@@ -62,6 +69,109 @@ class ReactorGreenlet(greenlet.greenlet):
     def __init__(self, run):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
+        # Callback that was running when this greenlet paused (profiling)
+        self.profile_name = None
+
+# Upper bounds (in seconds) of the callback run time histogram buckets
+PROFILE_BUCKETS = [.001, .002, .005, .010, .020, .050, .100, .200, .500, 1.]
+
+# Optional instrumentation of the time spent in each timer and fd
+# callback.  The time a callback spends paused (while other callbacks
+# run) is not counted.  A watchdog thread logs the stack of any callback
+# that runs longer than slow_time.
+class ReactorProfiler:
+    def __init__(self, reactor, slow_time):
+        self.monotonic = reactor.monotonic
+        self.slow_time = slow_time
+        self.names = {}
+        self.callback_stats = {}
+        self.slow_count = 0
+        self.period_max = 0.
+        # Currently running callback (name, start time)
+        self.segment = None
+        # Watchdog thread
+        self.thread_id = threading.get_ident()
+        self.sampled_segment = None
+        self.is_active = True
+        self.thread = threading.Thread(target=self._watchdog)
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.is_active = False
+    def _get_name(self, callback):
+        owner = getattr(callback, '__self__', None)
+        if isinstance(owner, ReactorCallback):
+            callback = owner.callback
+        elif isinstance(owner, ReactorGreenlet):
+            return owner.profile_name or "reactor.pause"
+        func = getattr(callback, '__func__', callback)
+        name = self.names.get(func)
+        if name is None:
+            qualname = getattr(func, '__qualname__', None)
+            if qualname is None:
+                name = repr(func)
+            else:
+                name = "%s.%s" % (getattr(func, '__module__', '?'), qualname)
+            self.names[func] = name
+        return name
+    def run(self, callback, eventtime):
+        self.segment = (self._get_name(callback), self.monotonic())
+        res = callback(eventtime)
+        self._end_segment()
+        return res
+    def note_pause(self, g):
+        # The running callback is switching out of greenlet g
+        segment = self.segment
+        if segment is not None:
+            g.profile_name = segment[0]
+            self._end_segment()
+    def _end_segment(self):
+        segment = self.segment
+        if segment is None:
+            return
+        self.segment = None
+        name, start = segment
+        run_time = self.monotonic() - start
+        stats = self.callback_stats.get(name)
+        if stats is None:
+            stats = self.callback_stats[name] = {
+                'count': 0, 'total': 0., 'max': 0.,
+                'histogram': [0] * (len(PROFILE_BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total'] += run_time
+        stats['max'] = max(stats['max'], run_time)
+        stats['histogram'][bisect.bisect_left(PROFILE_BUCKETS, run_time)] += 1
+        self.period_max = max(self.period_max, run_time)
+        if run_time > self.slow_time:
+            self.slow_count += 1
+            logging.warning("Slow reactor callback %s took %.3fs",
+                            name, run_time)
+    def _watchdog(self):
+        while self.is_active:
+            time.sleep(self.slow_time * .5)
+            segment = self.segment
+            if segment is None or segment is self.sampled_segment:
+                continue
+            run_time = self.monotonic() - segment[1]
+            if run_time < self.slow_time:
+                continue
+            self.sampled_segment = segment
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            logging.warning("Reactor callback %s running for %.3fs:\n%s",
+                            segment[0], run_time, stack)
+    def get_period_max(self):
+        # Longest callback run time since the last call
+        period_max = self.period_max
+        self.period_max = 0.
+        return period_max
+    def get_stats(self):
+        return {'slow_time': self.slow_time, 'slow_count': self.slow_count,
+                'buckets': PROFILE_BUCKETS,
+                'callbacks': {name: dict(stats) for name, stats
+                              in self.callback_stats.items()}}
 
 class ReactorMutex:
     def __init__(self, reactor, is_locked):
@@ -73,6 +183,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return not not self.queue
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -102,9 +214,17 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        # Timers - a heap of (waketime, seq, timer) entries.  Entries are
+        # not removed when a timer is updated or unregistered; an entry is
+        # stale once its seq no longer matches the timer's seq.  Entries
+        # added while timers are dispatched wait in _timer_pending.
+        self._timer_heap = []
+        self._timer_pending = []
+        self._timer_seq = 0
+        self._timer_stale = 0
         self._next_timer = self.NEVER
+        # Callback profiling
+        self._profiler = None
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
@@ -117,22 +237,44 @@ class SelectReactor:
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def enable_profiling(self, slow_time):
+        if self._profiler is None:
+            self._profiler = ReactorProfiler(self, slow_time)
+        return self._profiler
+    def get_profiler(self):
+        return self._profiler
     # Timers
+    def _queue_timer(self, timer_handler, waketime):
+        if timer_handler.seq:
+            self._timer_stale += 1
+        if waketime >= self.NEVER:
+            timer_handler.seq = 0
+            return
+        self._timer_seq += 1
+        timer_handler.seq = seq = self._timer_seq
+        self._timer_pending.append((waketime, seq, timer_handler))
+        if waketime < self._next_timer:
+            self._next_timer = waketime
+    def _compact_timers(self):
+        heap = self._timer_heap
+        heap[:] = [e for e in heap if e[1] == e[2].seq]
+        heapq.heapify(heap)
+        pending = self._timer_pending
+        pending[:] = [e for e in pending if e[1] == e[2].seq]
+        self._timer_stale = 0
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
-        self._next_timer = min(self._next_timer, waketime)
+        if timer_handler.seq is not None:
+            self._queue_timer(timer_handler, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
-        self._next_timer = min(self._next_timer, waketime)
+        self._queue_timer(timer_handler, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        if timer_handler.seq:
+            self._timer_stale += 1
+        timer_handler.seq = None
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -151,17 +293,42 @@ class SelectReactor:
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        heap = self._timer_heap
+        if (self._timer_stale > TIMER_COMPACT_COUNT
+            and self._timer_stale * 2 > len(heap)):
+            self._compact_timers()
+        pending = self._timer_pending
+        if pending:
+            for entry in pending:
+                heapq.heappush(heap, entry)
+            del pending[:]
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
+        while heap:
+            waketime, seq, t = heap[0]
+            if seq != t.seq:
+                # Timer was updated or unregistered since entry was added
+                heapq.heappop(heap)
+                self._timer_stale -= 1
+                continue
+            if eventtime < waketime:
+                break
+            heapq.heappop(heap)
+            t.seq = 0
+            t.waketime = self.NEVER
+            if self._profiler is None:
                 t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+            else:
+                t.waketime = waketime = self._profiler.run(t.callback,
+                                                           eventtime)
+            if t.seq is not None:
+                self._queue_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                if heap:
+                    self._next_timer = min(self._next_timer, heap[0][0])
+                self._end_greenlet(g_dispatch)
+                return 0.
+        if heap:
+            self._next_timer = min(self._next_timer, heap[0][0])
         return 0.
     # Callbacks and Completions
     def completion(self):
@@ -208,6 +375,8 @@ class SelectReactor:
         return self.monotonic()
     def pause(self, waketime):
         g = greenlet.getcurrent()
+        if self._profiler is not None:
+            self._profiler.note_pause(g)
         if g is not self._g_dispatch:
             if self._g_dispatch is None:
                 return self._sys_pause(waketime)
@@ -241,7 +410,7 @@ class SelectReactor:
     # File descriptors
     def register_fd(self, fd, read_callback, write_callback=None):
         file_handler = ReactorFileHandler(fd, read_callback, write_callback)
-        self.set_fd_wake(file_handle, True, False)
+        self.set_fd_wake(file_handler, True, False)
         return file_handler
     def unregister_fd(self, file_handler):
         if file_handler in self._read_fds:
@@ -249,12 +418,12 @@ class SelectReactor:
         if file_handler in self._write_fds:
             self._write_fds.pop(self._write_fds.index(file_handler))
     def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
-        if file_hander in self._read_fds:
+        if file_handler in self._read_fds:
             if not is_readable:
                 self._read_fds.pop(self._read_fds.index(file_handler))
         elif is_readable:
             self._read_fds.append(file_handler)
-        if file_hander in self._write_fds:
+        if file_handler in self._write_fds:
             if not is_writeable:
                 self._write_fds.pop(self._write_fds.index(file_handler))
         elif is_writeable:
@@ -271,14 +440,20 @@ class SelectReactor:
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.read_callback(eventtime)
+                if self._profiler is None:
+                    fd.read_callback(eventtime)
+                else:
+                    self._profiler.run(fd.read_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
             for fd in res[1]:
                 busy = True
-                fd.write_callback(eventtime)
+                if self._profiler is None:
+                    fd.write_callback(eventtime)
+                else:
+                    self._profiler.run(fd.write_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -294,6 +469,8 @@ class SelectReactor:
     def end(self):
         self._process = False
     def finalize(self):
+        if self._profiler is not None:
+            self._profiler.stop()
         self._g_dispatch = None
         self._greenlets = []
         for g in self._all_greenlets:
@@ -345,13 +522,21 @@ class PollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.POLLIN | select.POLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profiler.run(self._fds[fd].read_callback,
+                                           eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.POLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profiler.run(self._fds[fd].write_callback,
+                                           eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
@@ -367,7 +552,7 @@ class EPollReactor(SelectReactor):
     def register_fd(self, fd, read_callback, write_callback=None):
         file_handler = ReactorFileHandler(fd, read_callback, write_callback)
         fds = self._fds.copy()
-        fds[fd] = callback
+        fds[fd] = file_handler
         self._fds = fds
         self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
         return file_handler
@@ -396,13 +581,21 @@ class EPollReactor(SelectReactor):
             for fd, event in res:
                 busy = True
                 if event & (select.EPOLLIN | select.EPOLLHUP):
-                    self._fds[fd].read_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].read_callback(eventtime)
+                    else:
+                        self._profiler.run(self._fds[fd].read_callback,
+                                           eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
                         break
                 if event & select.EPOLLOUT:
-                    self._fds[fd].write_callback(eventtime)
+                    if self._profiler is None:
+                        self._fds[fd].write_callback(eventtime)
+                    else:
+                        self._profiler.run(self._fds[fd].write_callback,
+                                           eventtime)
                     if g_dispatch is not self._g_dispatch:
                         self._end_greenlet(g_dispatch)
                         eventtime = self.monotonic()
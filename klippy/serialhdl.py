@@ -12,6 +12,9 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Maximum number of messages obtained from the serial queue at a time
+PULL_MESSAGE_COUNT = 32
+
 class SerialReader:
     def __init__(self, reactor, warn_prefix=""):
         self.reactor = reactor
@@ -27,7 +30,9 @@ class SerialReader:
         # Threading
         self.lock = threading.Lock()
         self.background_thread = None
-        # Message handlers
+        # Message handlers - the dict is replaced (never modified) on
+        # each registration so the background thread can read it
+        # without taking the lock.  Entries are (callback, is_batch).
         self.handlers = {}
         self.register_response(self._handle_unknown_init, '#unknown')
         self.register_response(self.handle_output, '#output')
@@ -35,29 +40,55 @@ class SerialReader:
         self.last_notify_id = 0
         self.pending_notifications = {}
     def _bg_thread(self):
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_MESSAGE_COUNT,))
+        default_handler = (self.handle_default, False)
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
-            if count < 0:
+            rcount = self.ffi_lib.serialqueue_pull_many(
+                self.serialqueue, responses, PULL_MESSAGE_COUNT)
+            if rcount < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
-                    hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+            # A run of consecutive messages for the same batch handler is
+            # delivered as one list before any other message is handled,
+            # so batching never reorders the serial stream
+            batch_hdl = batch = None
+            for i in range(rcount):
+                response = responses[i]
+                if response.notify_id:
+                    if batch_hdl is not None:
+                        self._deliver(batch_hdl, batch)
+                        batch_hdl = None
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    completion = self.pending_notifications.pop(
+                        response.notify_id)
+                    self.reactor.async_complete(completion, params)
+                    continue
+                msg = self.ffi_main.buffer(response.msg, response.len)[:]
+                params = self.msgparser.parse(msg)
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                hdl, is_batch = self.handlers.get(
+                    (params['#name'], params.get('oid')), default_handler)
+                if is_batch and hdl is batch_hdl:
+                    batch.append(params)
+                    continue
+                if batch_hdl is not None:
+                    self._deliver(batch_hdl, batch)
+                    batch_hdl = None
+                if is_batch:
+                    batch_hdl = hdl
+                    batch = [params]
+                    continue
+                self._deliver(hdl, params)
+            if batch_hdl is not None:
+                self._deliver(batch_hdl, batch)
+    def _deliver(self, hdl, params):
+        try:
+            hdl(params)
+        except:
+            logging.exception("%sException in serial callback",
+                              self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
     def _get_identify_data(self, eventtime):
@@ -231,14 +262,18 @@ class SerialReader:
         return self.serialqueue
     def get_default_command_queue(self):
         return self.default_cmd_queue
-    # Serial response callbacks
-    def register_response(self, callback, name, oid=None):
+    # Serial response callbacks.  Callbacks are run in the background
+    # thread.  A "batch" callback is passed a list of all the matching
+    # messages obtained in one read of the serial queue.  Note that a
+    # callback may still be invoked (once) just after it is unregistered.
+    def register_response(self, callback, name, oid=None, batch=False):
         with self.lock:
+            handlers = dict(self.handlers)
             if callback is None:
-              if (name, oid) in self.handlers:
-                del self.handlers[name, oid]
+                handlers.pop((name, oid), None)
             else:
-                self.handlers[name, oid] = callback
+                handlers[name, oid] = (callback, batch)
+            self.handlers = handlers
     # Command sending
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
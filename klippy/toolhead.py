@@ -657,9 +657,13 @@ class ToolHead:
         }
         saving_section = {"printer": position_config}
         configfile.update_config(setting_sections=saving_section, save_immediatly=True)
+        # Called on shutdown and exit - write the file out now
+        configfile.flush()
 
     def _handle_system_shutdown(self, signum, frame):
-        self._write_last_position()
+        # The signal may arrive in the middle of a reactor callback, so
+        # only request the exit here - the last position is written from
+        # the "klippy:disconnect" handler once the reactor has stopped.
         logging.info("Received signal %d, initiating shutdown...", signum)
         # Инициировать корректное завершение работы
         # self.printer.invoke_shutdown("System shutdown signal received")
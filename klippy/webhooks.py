@@ -3,11 +3,21 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
+import logging, socket, os, sys, errno, json, collections, itertools
 import gcode
 import locales 
 locales.set_locale()
 REQUEST_LOG_SIZE = 20
+# Default high-water mark (in bytes) of a client's send queue.  With the
+# "drop" policy, droppable messages (eg, bulk sensor batches) are not
+# queued above this mark and the client is disconnected once the queue
+# grows to SEND_CLOSE_FACTOR times the mark.  With the "disconnect"
+# policy the client is disconnected as soon as the mark is exceeded.
+DEFAULT_SEND_LIMIT = 256 * 1024
+SEND_POLICIES = ['drop', 'disconnect']
+SEND_CLOSE_FACTOR = 16
+# Maximum number of queued chunks passed to a single sendmsg() call
+SEND_MAX_CHUNKS = 64
 
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
@@ -27,6 +37,110 @@ if sys.version_info.major < 3:
                     for k, v in data.items()}
         return data
 
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Use a faster json encoder when one is installed.  Objects that it can
+# not encode fall back to the standard library encoder.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+    # Older ujson versions do not support the default= parameter
+    if ujson.dumps(object(), default=lambda obj: 0) != '0':
+        ujson = None
+except (ImportError, TypeError):
+    ujson = None
+
+def _json_dumps_stdlib(data, default):
+    return json.dumps(data, separators=(',', ':'), default=default).encode()
+
+if orjson is not None:
+    JSON_ENCODER = "orjson"
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    def _json_dumps_fast(data, default):
+        return orjson.dumps(data, default=default, option=ORJSON_OPTIONS)
+elif ujson is not None:
+    JSON_ENCODER = "ujson"
+    def _json_dumps_fast(data, default):
+        return ujson.dumps(data, ensure_ascii=False, default=default,
+                           escape_forward_slashes=False).encode()
+else:
+    JSON_ENCODER = "json"
+    _json_dumps_fast = None
+
+if _json_dumps_fast is not None:
+    def _json_dumps(data, default):
+        try:
+            return _json_dumps_fast(data, default)
+        except (TypeError, OverflowError):
+            return _json_dumps_stdlib(data, default)
+else:
+    _json_dumps = _json_dumps_stdlib
+
+def _json_default(obj):
+    # Named tuples (eg, gcode.Coord positions in toolhead status)
+    if isinstance(obj, tuple):
+        return list(obj)
+    # Numpy arrays and scalars
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % (type(obj).__name__,))
+
+def check_json_encoder():
+    # Verify that the fast encoder handles a typical status message
+    # itself, without falling back to the (slower) standard library
+    if _json_dumps_fast is None:
+        return True
+    status = {'toolhead': {'position': gcode.Coord(1., 2., 3., 4.),
+                           'homed_axes': "xyz"}}
+    try:
+        data = _json_dumps_fast(status, _json_default)
+    except (TypeError, OverflowError):
+        return False
+    return json.loads(data) == json.loads(
+        _json_dumps_stdlib(status, _json_default))
+
+def json_dumps(data):
+    return _json_dumps(data, _json_default)
+
+# Pre-encoded json that is spliced into a message by encode_json_chunks()
+class JsonFragment:
+    def __init__(self, value):
+        self.data = json_dumps(value)
+
+def encode_json_chunks(data):
+    # Encode data as a sequence of byte strings.  The pre-encoded data of
+    # JsonFragment objects is returned as separate chunks.  Each fragment
+    # is encoded as a placeholder string containing a random token, so
+    # no string in the message can be mistaken for a placeholder.
+    fragments = []
+    token = []
+    def default(obj):
+        if isinstance(obj, JsonFragment):
+            if not token:
+                token.append(os.urandom(12).hex())
+            fragments.append(obj.data)
+            return "%s:%d" % (token[0], len(fragments) - 1)
+        return _json_default(obj)
+    encoded = _json_dumps(data, default)
+    if not fragments:
+        return (encoded,)
+    parts = encoded.split(('"%s:' % (token[0],)).encode())
+    chunks = [parts[0]]
+    for part in parts[1:]:
+        index, sep, rest = part.partition(b'"')
+        index = int(index)
+        if not sep or index >= len(fragments) or fragments[index] is None:
+            raise ValueError("Invalid json fragment placeholder")
+        chunks.append(fragments[index])
+        fragments[index] = None
+        if rest:
+            chunks.append(rest)
+    return chunks
+
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
         Exception.__init__(self, message)
@@ -113,6 +227,8 @@ class ServerSocket:
         self.sock = self.fd_handle = None
         self.clients = {}
         start_args = printer.get_start_args()
+        self.send_limit = start_args.get('api_send_limit', DEFAULT_SEND_LIMIT)
+        self.send_policy = start_args.get('api_send_policy', 'drop')
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
         if not server_address or is_fileinput:
@@ -166,6 +282,9 @@ class ServerSocket:
     def pop_client(self, client_id):
         self.clients.pop(client_id, None)
 
+    def get_clients(self):
+        return list(self.clients.values())
+
     def stats(self, eventtime):
         # Called once per second - check for idle clients
         for client in list(self.clients.values()):
@@ -186,9 +305,21 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        # Pending output is kept as a queue of encoded chunks
+        self.send_chunks = collections.deque()
+        self.send_limit = server.send_limit
+        self.close_limit = self.send_limit
+        if server.send_policy == 'drop':
+            self.close_limit *= SEND_CLOSE_FACTOR
         self.is_blocking = False
         self.blocking_count = 0
+        self.stall_start_time = 0.
+        # Connection metrics
+        self.queued_bytes = self.max_queued_bytes = self.sent_bytes = 0
+        self.dropped_count = self.stall_count = 0
+        self.stall_time = 0.
+        self.client_info = None
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
 
@@ -205,6 +336,7 @@ class ClientConnection:
             state_msg = "Client info %s" % (repr(client_info),)
         logging.info("webhooks client %s: %s", self.uid, state_msg)
         log_id = "webhooks %s" % (self.uid,)
+        self.client_info = client_info
         if client_info is None:
             self.printer.set_rollover_info(log_id, None, log=False)
             return
@@ -222,10 +354,24 @@ class ClientConnection:
         except socket.error:
             pass
         self.server.pop_client(self.uid)
+        self.send_chunks.clear()
+        self.queued_bytes = 0
 
     def is_closed(self):
         return self.fd_handle is None
 
+    def get_stats(self, eventtime):
+        stall_time = self.stall_time
+        if self.is_blocking:
+            stall_time += eventtime - self.stall_start_time
+        return {'client_id': self.uid, 'client_info': self.client_info,
+                'queued_bytes': self.queued_bytes,
+                'max_queued_bytes': self.max_queued_bytes,
+                'sent_bytes': self.sent_bytes,
+                'dropped_messages': self.dropped_count,
+                'stall_count': self.stall_count, 'stall_time': stall_time,
+                'is_blocking': self.is_blocking}
+
     def process_received(self, eventtime):
         try:
             data = self.sock.recv(4096)
@@ -272,31 +418,85 @@ class ClientConnection:
         self.send(result)
 
     def send(self, data):
-        jmsg = json.dumps(data, separators=(',', ':'))
-        self.send_buffer += jmsg.encode() + b"\x03"
+        self._queue_chunks(encode_json_chunks(data))
+
+    def send_encoded(self, chunks, droppable=False):
+        # Send a message already encoded as json (a sequence of byte
+        # strings).  Droppable messages are discarded instead of queued
+        # while the client is not keeping up.
+        if droppable and self.queued_bytes >= self.send_limit:
+            if not self.dropped_count:
+                logging.info("webhooks client %s: send queue full,"
+                             " dropping messages", self.uid)
+            self.dropped_count += 1
+            return False
+        self._queue_chunks(chunks)
+        return True
+
+    def _queue_chunks(self, chunks):
+        if self.fd_handle is None:
+            return
+        send_chunks = self.send_chunks
+        for chunk in chunks:
+            send_chunks.append(chunk)
+            self.queued_bytes += len(chunk)
+        send_chunks.append(b"\x03")
+        self.queued_bytes += 1
         if not self.is_blocking:
             self._do_send()
+        if self.queued_bytes > self.max_queued_bytes:
+            self.max_queued_bytes = self.queued_bytes
+        if self.queued_bytes > self.close_limit:
+            logging.info("webhooks client %s: %d bytes queued, closing"
+                         " connection", self.uid, self.queued_bytes)
+            self.close()
+
+    def _send_chunks(self):
+        send_chunks = self.send_chunks
+        if len(send_chunks) == 1 or not HAVE_SENDMSG:
+            return self.sock.send(send_chunks[0])
+        if len(send_chunks) <= SEND_MAX_CHUNKS:
+            return self.sock.sendmsg(send_chunks)
+        return self.sock.sendmsg(
+            itertools.islice(send_chunks, SEND_MAX_CHUNKS))
 
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
-        try:
-            sent = self.sock.send(self.send_buffer)
-        except socket.error as e:
-            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                logging.info(_("webhooks: socket write error %d") % (self.uid,))
-                self.close()
-                return
-            sent = 0
-        if sent < len(self.send_buffer):
+        send_chunks = self.send_chunks
+        while send_chunks:
+            try:
+                sent = self._send_chunks()
+            except socket.error as e:
+                if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    logging.info(_("webhooks: socket write error %d")
+                                 % (self.uid,))
+                    self.close()
+                    return
+                sent = 0
+            if not sent:
+                break
+            self.sent_bytes += sent
+            self.queued_bytes -= sent
+            # Release fully written chunks; keep a view of a partial one
+            while sent:
+                chunk_len = len(send_chunks[0])
+                if sent < chunk_len:
+                    send_chunks[0] = memoryview(send_chunks[0])[sent:]
+                    break
+                send_chunks.popleft()
+                sent -= chunk_len
+        if send_chunks:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
                 self.blocking_count = 5
+                self.stall_count += 1
+                self.stall_start_time = self.reactor.monotonic()
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
+            self.stall_time += self.reactor.monotonic() - self.stall_start_time
 
 class WebHooks:
     def __init__(self, printer):
@@ -308,7 +508,14 @@ class WebHooks:
         self.register_endpoint("emergency_stop", self._handle_estop_request)
         self.register_endpoint("register_remote_method",
                                self._handle_rpc_registration)
+        self.register_endpoint("webhooks/connections",
+                               self._handle_connections)
         self.sconn = ServerSocket(self, printer)
+        logging.info("webhooks: using %s json encoder", JSON_ENCODER)
+        if not check_json_encoder():
+            logging.warning("webhooks: %s json encoder can not encode status"
+                            " messages - they will be encoded twice",
+                            JSON_ENCODER)
 
     def register_endpoint(self, path, callback):
         if path in self._endpoints:
@@ -360,6 +567,14 @@ class WebHooks:
             response[sa] = start_args.get(sa)
         web_request.send(response)
 
+    def _handle_connections(self, web_request):
+        eventtime = self.printer.get_reactor().monotonic()
+        web_request.send({
+            'send_limit': self.sconn.send_limit,
+            'send_policy': self.sconn.send_policy,
+            'connections': [c.get_stats(eventtime)
+                            for c in self.sconn.get_clients()]})
+
     def _handle_estop_request(self, web_request):
         self.printer.invoke_shutdown(_("Shutdown due to webhooks request\n"))
 
@@ -414,6 +629,7 @@ class GCodeHelper:
         # Output subscription tracking
         self.is_output_registered = False
         self.clients = {}
+        self.help_fragment = (None, None)
         # Register webhooks
         wh: WebHooks = printer.lookup_object('webhooks')
         wh.register_endpoint("gcode/help", self._handle_help)
@@ -425,7 +641,11 @@ class GCodeHelper:
         wh.register_endpoint("gcode/subscribe_output",
                              self._handle_subscribe_output)
     def _handle_help(self, web_request):
-        web_request.send(self.gcode.get_command_help())
+        # The help dict is only replaced when commands change
+        cmdhelp = self.gcode.get_command_help()
+        if self.help_fragment[0] is not cmdhelp:
+            self.help_fragment = (cmdhelp, JsonFragment(cmdhelp))
+        web_request.send(self.help_fragment[1])
     def _handle_script(self, web_request):
         self.gcode.run_script(web_request.get_str('script'))
     def _handle_restart(self, web_request):
@@ -458,6 +678,27 @@ class GCodeHelper:
             self.is_output_registered = True
 
 SUBSCRIPTION_REFRESH_TIME = .25
+MIN_SUBSCRIPTION_INTERVAL = .05
+
+# Printer objects may implement get_status_version(eventtime), returning
+# a value that only changes when get_status() would return different
+# data.  The last status of such objects is reused while the version is
+# unchanged, so their status dicts are neither rebuilt nor compared.
+# Objects may also implement get_status_fragments(), returning the names
+# of status fields that are never modified in place (a new value is
+# assigned on change).  Those values are json encoded once and the
+# encoding is reused for as long as the same value is reported.
+class StatusClient:
+    def __init__(self, cconn, subscription, send_func, template,
+                 interval=SUBSCRIPTION_REFRESH_TIME):
+        self.cconn = cconn
+        self.subscription = subscription
+        self.send_func = send_func
+        self.template = template
+        self.interval = interval
+        self.next_time = 0.
+        # Status last reported to this client for each object
+        self.last_status = {}
 
 class QueryStatusHelper:
     def __init__(self, printer):
@@ -465,7 +706,9 @@ class QueryStatusHelper:
         self.clients = {}
         self.pending_queries = []
         self.query_timer = None
-        self.last_query = {}
+        self.status_cache = {}
+        self.fragment_fields = {}
+        self.fragment_cache = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
@@ -475,52 +718,97 @@ class QueryStatusHelper:
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _get_status(self, obj_name, eventtime, query):
+        res = query.get(obj_name, None)
+        if res is not None:
+            return res
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            res = {}
+        elif hasattr(po, 'get_status_version'):
+            version = po.get_status_version(eventtime)
+            cached = self.status_cache.get(obj_name)
+            if cached is not None and cached[0] == version:
+                res = cached[1]
+            else:
+                res = po.get_status(eventtime)
+                self.status_cache[obj_name] = (version, res)
+        else:
+            res = po.get_status(eventtime)
+        query[obj_name] = res
+        return res
+    def _get_fragment_fields(self, obj_name):
+        fields = self.fragment_fields.get(obj_name)
+        if fields is None:
+            po = self.printer.lookup_object(obj_name, None)
+            if po is None:
+                return ()
+            fields = ()
+            if hasattr(po, 'get_status_fragments'):
+                fields = po.get_status_fragments()
+            self.fragment_fields[obj_name] = fields
+        return fields
+    def _get_fragment(self, obj_name, item, value):
+        key = (obj_name, item)
+        cached = self.fragment_cache.get(key)
+        if cached is None or cached[0] is not value:
+            cached = self.fragment_cache[key] = (value, JsonFragment(value))
+        return cached[1]
     def _do_query(self, eventtime):
-        last_query = self.last_query
-        query = self.last_query = {}
+        reactor = self.printer.get_reactor()
+        query = {}
         msglist = self.pending_queries
         self.pending_queries = []
-        msglist.extend(self.clients.values())
-        # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
-            is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
+        waketime = reactor.NEVER
+        for client in list(self.clients.values()):
+            if client.cconn.is_closed():
+                del self.clients[client.cconn]
+                continue
+            if eventtime < client.next_time:
+                waketime = min(waketime, client.next_time)
                 continue
+            client.next_time = eventtime + client.interval
+            waketime = min(waketime, client.next_time)
+            msglist.append(client)
+        # Generate get_status() info for each client
+        for client in msglist:
+            is_query = client.cconn is None
+            subscription = client.subscription
+            last_status = client.last_status
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
-                res = query.get(obj_name, None)
-                if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                res = self._get_status(obj_name, eventtime, query)
+                fragment_fields = self._get_fragment_fields(obj_name)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
-                lres = last_query.get(obj_name, {})
+                lres = last_status.get(obj_name, {})
+                last_status[obj_name] = res
+                if res is lres and not is_query:
+                    # Status object unchanged since last report
+                    continue
                 cres = {}
                 for ri in req_items:
                     rd = res.get(ri, None)
                     if is_query or rd != lres.get(ri):
+                        if ri in fragment_fields and rd is not None:
+                            rd = self._get_fragment(obj_name, ri, rd)
                         cres[ri] = rd
                 if cres or is_query:
                     cquery[obj_name] = cres
             # Send data
             if cquery or is_query:
-                tmp = dict(template)
+                tmp = dict(client.template)
                 tmp['params'] = {'eventtime': eventtime, 'status': cquery}
-                send_func(tmp)
-        if not query:
+                client.send_func(tmp)
+        if not self.clients:
             # Unregister timer if there are no longer any subscriptions
-            reactor = self.printer.get_reactor()
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
             return reactor.NEVER
-        return eventtime + SUBSCRIPTION_REFRESH_TIME
+        return waketime
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -531,6 +819,11 @@ class QueryStatusHelper:
                 for ri in v:
                     if type(ri) != str:
                         raise web_request.error(_("Invalid argument"))
+        interval = SUBSCRIPTION_REFRESH_TIME
+        if is_subscribe:
+            interval = web_request.get_float('interval', interval)
+            if interval < MIN_SUBSCRIPTION_INTERVAL:
+                raise web_request.error(_("Invalid argument"))
         # Add to pending queries
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
@@ -538,16 +831,29 @@ class QueryStatusHelper:
             del self.clients[cconn]
         reactor = self.printer.get_reactor()
         complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
+        query_client = StatusClient(None, objects, complete.complete, {})
+        self.pending_queries.append(query_client)
         # Start timer if needed
         if self.query_timer is None:
             qt = reactor.register_timer(self._do_query, reactor.NOW)
             self.query_timer = qt
+        else:
+            reactor.update_timer(self.query_timer, reactor.NOW)
         # Wait for data to be queried
         msg = complete.wait()
         web_request.send(msg['params'])
         if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+            client = StatusClient(cconn, objects, cconn.send, template,
+                                  interval)
+            client.last_status = query_client.last_status
+            client.next_time = msg['params']['eventtime'] + interval
+            self.clients[cconn] = client
+            if self.query_timer is None:
+                self.query_timer = reactor.register_timer(
+                    self._do_query, client.next_time)
+            elif client.next_time < self.query_timer.waketime:
+                # The timer was scheduled for the existing clients
+                reactor.update_timer(self.query_timer, client.next_time)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
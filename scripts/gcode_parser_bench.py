@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Benchmark g-code parsing and dispatch through GCodeDispatch
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor, gcode
+
+class DummyPrinter:
+    config_error = Exception
+    command_error = gcode.CommandError
+    def __init__(self):
+        self.reactor = reactor.Reactor()
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {}
+    def register_event_handler(self, event, callback):
+        pass
+    def send_event(self, event, *params):
+        pass
+
+class MoveCounter:
+    def __init__(self):
+        self.moves = 0
+        self.pos = [0., 0., 0., 0.]
+    def cmd_G1(self, gcmd):
+        move_params = gcmd.get_move_parameters()
+        for pos, axis in enumerate('XYZE'):
+            if axis in move_params:
+                self.pos[pos] = move_params[axis]
+        self.moves += 1
+    def cmd_other(self, gcmd):
+        pass
+
+def create_dispatch(counter):
+    gcode_dispatch = gcode.GCodeDispatch(DummyPrinter())
+    for cmd in ['G0', 'G1', 'G2', 'G3']:
+        gcode_dispatch.register_command(cmd, counter.cmd_G1)
+    for cmd in ['G90', 'G91', 'G92', 'M82', 'M83', 'M104', 'M106', 'M107',
+                'M109', 'M140', 'M190', 'M204']:
+        gcode_dispatch.register_command(cmd, counter.cmd_other)
+    gcode_dispatch.gcode_handlers = gcode_dispatch.ready_gcode_handlers
+    gcode_dispatch.is_printer_ready = True
+    return gcode_dispatch
+
+def generate_moves(count):
+    lines = ["G90", "M83"]
+    for i in range(count):
+        lines.append("G1 X%.3f Y%.3f E%.5f" % (100. + (i % 500) * .1,
+                                               100. + (i % 700) * .07, .0213))
+        if i % 50 == 0:
+            lines.append("G1 Z%.2f F9000 ; layer change" % (.2 * i / 50,))
+    return lines
+
+def run_scripts(gcode_dispatch, lines, scripts, chunk):
+    for script in scripts:
+        gcode_dispatch.run_script(script)
+
+def run_lines(gcode_dispatch, lines, scripts, chunk):
+    # One run_script() call per line (as virtual_sdcard used to do)
+    for line in lines:
+        gcode_dispatch.run_script(line)
+
+def run_batched(gcode_dispatch, lines, scripts, chunk):
+    line_cb = lambda: True
+    for i in range(0, len(lines), chunk):
+        gcode_dispatch.run_script_lines(iter(lines[i:i + chunk]), line_cb)
+
+def main():
+    usage = "%prog [options] [gcode file]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=200000, help="moves to generate without a file")
+    opts.add_option("-c", "--chunk", type="int", dest="chunk", default=1000,
+                    help="lines per run_script or run_script_lines call")
+    opts.add_option("-l", "--legacy", action="store_true", dest="legacy",
+                    help="also time the generic parser")
+    opts.add_option("-s", "--lines", action="store_true", dest="lines",
+                    help="also time per line run_script and run_script_lines")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    if args:
+        with open(args[0], 'r') as f:
+            lines = f.read().split('\n')
+    else:
+        lines = generate_moves(options.count)
+    scripts = ['\n'.join(lines[i:i + options.chunk])
+               for i in range(0, len(lines), options.chunk)]
+    tests = [("fast", False, run_scripts)]
+    if options.legacy:
+        tests.append(("legacy", True, run_scripts))
+    if options.lines:
+        tests.append(("lines", False, run_lines))
+        tests.append(("batched", False, run_batched))
+    for name, legacy, func in tests:
+        counter = MoveCounter()
+        gcode_dispatch = create_dispatch(counter)
+        if legacy:
+            gcode_dispatch._parse_move = lambda line: None
+        start = time.perf_counter()
+        func(gcode_dispatch, lines, scripts, options.chunk)
+        elapsed = time.perf_counter() - start
+        print("%-7s %d lines (%d moves) in %.3fs (%.0f lines/sec)"
+              % (name, len(lines), counter.moves, elapsed,
+                 len(lines) / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
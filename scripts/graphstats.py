@@ -4,7 +4,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import optparse, datetime
+import optparse, datetime, struct, math
 import matplotlib
 
 MAXBANDWIDTH=25000.
@@ -18,11 +18,49 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
+# Binary stats file written by the [statistics] stats_file option
+STATS_FILE_MAGIC = b"KLSTATS1"
+
+def parse_stats_file(f, mcu_prefix, apply_prefix):
+    out = []
+    names = []
+    while 1:
+        rtype = f.read(1)
+        if not rtype:
+            break
+        if rtype == b'K':
+            size, = struct.unpack("<I", f.read(4))
+            names = []
+            for key in f.read(size).decode().split('\n'):
+                prefix, sep, name = key.rpartition(':')
+                prefix += sep
+                if prefix != mcu_prefix and name in apply_prefix:
+                    name = key
+                names.append(name)
+            fmt = "<ddB%dd" % (len(names),)
+            fmt_size = struct.calcsize(fmt)
+            continue
+        data = f.read(fmt_size)
+        if len(data) < fmt_size:
+            break
+        vals = struct.unpack(fmt, data)
+        keyparts = {name: '%.15g' % (val,)
+                    for name, val in zip(names, vals[3:])
+                    if not math.isnan(val)}
+        if 'print_time' not in keyparts:
+            continue
+        keyparts['#sampletime'] = vals[1]
+        out.append(keyparts)
+    return out
+
 def parse_log(logname, mcu):
     if mcu is None:
         mcu = "mcu"
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
+    with open(logname, 'rb') as f:
+        if f.read(len(STATS_FILE_MAGIC)) == STATS_FILE_MAGIC:
+            return parse_stats_file(f, mcu_prefix, apply_prefix)
     f = open(logname, 'r')
     out = []
     for line in f:
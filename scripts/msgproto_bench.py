@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Benchmark the mcu protocol message parser and encoder
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, random
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import msgproto
+
+def load_traffic(mp, filename):
+    # Split a raw dump of mcu data (as read by parsedump.py) into messages
+    with open(filename, 'rb') as f:
+        data = f.read()
+    out = []
+    while data:
+        l = mp.check_packet(data)
+        if l == 0:
+            break
+        if l < 0:
+            data = data[1:]
+            continue
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(data[pos])
+            if not isinstance(mid, msgproto.MessageFormat):
+                break
+            params, next_pos = mid.parse(data, pos)
+            out.append((mid, data[pos:next_pos]))
+            pos = next_pos
+        data = data[l:]
+    return out
+
+def random_value(rnd, t):
+    if t.is_dynamic_string:
+        return bytes(rnd.randrange(256) for i in range(rnd.randrange(48)))
+    if isinstance(t, msgproto.Enumeration):
+        return rnd.choice(list(t.enums))
+    if rnd.random() < .5:
+        return rnd.randrange(0x60)
+    if t.max_length == 2:
+        return rnd.randrange(0x100)
+    if t.max_length == 3:
+        return rnd.randrange(0x10000)
+    return rnd.randrange(0x100000000)
+
+def make_traffic(mp, count):
+    # Generate random instances of each response in the dictionary
+    rnd = random.Random(0)
+    msgs = [mid for msgtag, msgtype, msgformat in mp.get_messages()
+            if msgtype == 'response'
+            for mid in [mp.messages_by_name[msgformat.split()[0]]]]
+    out = []
+    for i in range(count):
+        mid = msgs[i % len(msgs)]
+        params = [random_value(rnd, t) for t in mid.param_types]
+        out.append((mid, bytes(mid.encode(params))))
+    return out
+
+# The generic per-parameter loops previously used by MessageFormat
+def legacy_parse(mid, s, pos):
+    pos += 1
+    out = {}
+    for name, t in mid.param_names:
+        v, pos = t.parse(s, pos)
+        out[name] = v
+    return out, pos
+
+def legacy_encode(mid, params):
+    out = []
+    out.append(mid.msgid)
+    for i, t in enumerate(mid.param_types):
+        t.encode(out, params[i])
+    return out
+
+def run_legacy_parse(traffic):
+    for mid, s in traffic:
+        legacy_parse(mid, s, 0)
+
+def run_parse(traffic):
+    for mid, s in traffic:
+        mid.parse(s, 0)
+
+def run_parse_tuple(traffic):
+    for mid, s in traffic:
+        mid.parse_tuple(s, 0)
+
+def get_encode_params(traffic):
+    return [(mid, list(mid.parse_tuple(s, 0)[0])) for mid, s in traffic]
+
+def run_legacy_encode(params):
+    for mid, p in params:
+        legacy_encode(mid, p)
+
+def run_encode(params):
+    for mid, p in params:
+        mid.encode(p)
+
+def main():
+    usage = "%prog [options] <dictionary file> [<serial data dump>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--repeat", type="int", dest="repeat", default=5,
+                    help="number of timed runs")
+    opts.add_option("-c", "--count", type="int", dest="count", default=100000,
+                    help="number of random messages when no dump is given")
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    with open(args[0], 'rb') as f:
+        dictionary = f.read()
+    mp = msgproto.MessageParser()
+    start = time.perf_counter()
+    mp.process_identify(dictionary, decompress=False)
+    print("identify %d messages in %.3fs" % (
+        len(mp.get_messages()), time.perf_counter() - start))
+    if len(args) == 2:
+        traffic = load_traffic(mp, args[1])
+    else:
+        traffic = make_traffic(mp, options.count)
+    params = get_encode_params(traffic)
+    tests = [("legacy parse", run_legacy_parse, traffic),
+             ("parse", run_parse, traffic),
+             ("parse_tuple", run_parse_tuple, traffic),
+             ("legacy encode", run_legacy_encode, params),
+             ("encode", run_encode, params)]
+    for name, func, data in tests:
+        times = []
+        for i in range(options.repeat):
+            start = time.perf_counter()
+            func(data)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print("%-13s best %.3fs (%d msgs, %.0f msgs/sec)"
+              % (name, best, len(data), len(data) / max(best, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Benchmark reactor timer churn and timer dispatch latency
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, random, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+import reactor
+
+# The list based timer queue used before the timer heap (for comparison)
+class LegacyTimers:
+    def update_timer(self, timer_handler, waketime):
+        timer_handler.waketime = waketime
+        self._next_timer = min(self._next_timer, waketime)
+    def register_timer(self, callback, waketime=reactor._NEVER):
+        timer_handler = reactor.ReactorTimer(callback, waketime)
+        timers = list(getattr(self, '_timers', []))
+        timers.append(timer_handler)
+        self._timers = timers
+        self._next_timer = min(self._next_timer, waketime)
+        return timer_handler
+    def unregister_timer(self, timer_handler):
+        timer_handler.waketime = self.NEVER
+        timers = list(self._timers)
+        timers.pop(timers.index(timer_handler))
+        self._timers = timers
+    def _check_timers(self, eventtime, busy):
+        if eventtime < self._next_timer:
+            if busy:
+                return 0.
+            return min(1., max(.001, self._next_timer - eventtime))
+        self._next_timer = self.NEVER
+        g_dispatch = self._g_dispatch
+        for t in self._timers:
+            waketime = t.waketime
+            if eventtime >= waketime:
+                t.waketime = self.NEVER
+                t.waketime = waketime = t.callback(eventtime)
+                if g_dispatch is not self._g_dispatch:
+                    self._next_timer = min(self._next_timer, waketime)
+                    self._end_greenlet(g_dispatch)
+                    return 0.
+            self._next_timer = min(self._next_timer, waketime)
+        return 0.
+
+class LegacyPollReactor(LegacyTimers, reactor.PollReactor):
+    pass
+
+def time_churn(r, count):
+    # Register and unregister short-lived timers directly
+    timers = []
+    start = time.perf_counter()
+    for i in range(count):
+        timers.append(r.register_timer(lambda e: r.NEVER,
+                                       r.monotonic() + random.random()))
+        if len(timers) > 16:
+            r.unregister_timer(timers.pop(random.randrange(len(timers))))
+    for t in timers:
+        r.unregister_timer(t)
+    return time.perf_counter() - start
+
+def time_dispatch(r, options):
+    # Background timers that wake periodically and do nothing
+    def make_periodic(interval):
+        return lambda e: e + interval
+    for i in range(options.timers):
+        r.register_timer(make_periodic(.050 + .010 * (i % 50)),
+                         r.monotonic() + random.random() * .1)
+    # A timer that churns short-lived timers (like button and message
+    # handlers do) on each wakeup
+    churn = []
+    def churn_timer(eventtime):
+        for i in range(options.churn):
+            churn.append(r.register_timer(lambda e: r.NEVER,
+                                          eventtime + random.random()))
+        while len(churn) > options.churn * 4:
+            r.unregister_timer(churn.pop(0))
+        return eventtime + .002
+    r.register_timer(churn_timer, r.NOW)
+    # A probe timer that measures how late it is dispatched
+    latencies = []
+    def probe_timer(eventtime, next_waketime=[0.]):
+        if next_waketime[0]:
+            latencies.append(r.monotonic() - next_waketime[0])
+        next_waketime[0] = eventtime + .001
+        return next_waketime[0]
+    r.register_timer(probe_timer, r.NOW)
+    r.register_timer(lambda e: r.end() or r.NEVER,
+                     r.monotonic() + options.duration)
+    r.run()
+    r.finalize()
+    latencies.sort()
+    return (sum(latencies) / max(1, len(latencies)),
+            latencies[int(len(latencies) * .99)] if latencies else 0.,
+            len(latencies))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timers", type="int", dest="timers", default=60,
+                    help="number of periodic background timers")
+    opts.add_option("-c", "--churn", type="int", dest="churn", default=4,
+                    help="short-lived timers created per churn wakeup")
+    opts.add_option("-n", "--count", type="int", dest="count",
+                    default=100000, help="register/unregister operations")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=2., help="seconds to run the dispatch test")
+    opts.add_option("-l", "--legacy", action="store_true", dest="legacy",
+                    help="also time the list based timer queue")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    tests = [("heap", reactor.PollReactor)]
+    if options.legacy:
+        tests.append(("legacy", LegacyPollReactor))
+    for name, reactor_class in tests:
+        r = reactor_class()
+        for i in range(options.timers):
+            r.register_timer(lambda e: r.NEVER, r.NEVER)
+        elapsed = time_churn(r, options.count)
+        avg, p99, count = time_dispatch(reactor_class(), options)
+        print("%-7s churn %.0f ops/sec, probe latency avg %.3fms"
+              " p99 %.3fms (%d wakeups)"
+              % (name, options.count / elapsed, avg * 1000., p99 * 1000.,
+                 count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Benchmark the virtual_sdcard g-code file reader
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+virtual_sdcard = importlib.import_module('.virtual_sdcard', 'extras')
+
+def run_reader(filename, read_size):
+    count = pos = 0
+    with open(filename, 'rb') as f:
+        reader = virtual_sdcard.GCodeFileReader(f, read_size)
+        while 1:
+            lines = reader.read_lines()
+            if lines is None:
+                break
+            for pos, line in lines:
+                count += 1
+    return count, pos
+
+def run_legacy(filename, read_size):
+    # The text-mode loop previously used by VirtualSD.work_handler
+    count = pos = 0
+    partial_input = ""
+    with open(filename, 'r', newline='') as f:
+        while 1:
+            data = f.read(read_size)
+            if not data:
+                break
+            lines = data.split('\n')
+            lines[0] = partial_input + lines[0]
+            partial_input = lines.pop()
+            for line in lines:
+                pos += len(line.encode()) + 1
+                count += 1
+    return count, pos
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--read_size", type="int", dest="read_size",
+                    default=virtual_sdcard.DEFAULT_WORK_READ_SIZE,
+                    help="bytes per file read")
+    opts.add_option("-l", "--legacy", action="store_true", dest="legacy",
+                    help="also time the old text-mode reader")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    tests = [("reader", run_reader)]
+    if options.legacy:
+        tests.append(("legacy", run_legacy))
+    for name, func in tests:
+        start = time.perf_counter()
+        count, pos = func(args[0], options.read_size)
+        elapsed = time.perf_counter() - start
+        print("%-7s %d lines, %d bytes in %.3fs (%.0f lines/sec)"
+              % (name, count, pos, elapsed, count / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Benchmark input shaper calibration on recorded accelerometer data
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, optparse, os, sys, time
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'klippy'))
+shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+
+def load_data(helper, logname):
+    if logname.endswith('.npy'):
+        data = np.load(logname, mmap_mode='r')
+    else:
+        with open(logname) as f:
+            for header in f:
+                if not header.startswith('#'):
+                    break
+        if header.startswith('freq,psd_x,psd_y,psd_z,psd_xyz'):
+            data = np.loadtxt(logname, skiprows=1, comments='#',
+                              delimiter=',')
+            calibration_data = shaper_calibrate.CalibrationData(
+                    freq_bins=data[:,0], psd_sum=data[:,4],
+                    psd_x=data[:,1], psd_y=data[:,2], psd_z=data[:,3])
+            calibration_data.set_numpy(np)
+            if 'mzv' not in header:
+                calibration_data.normalize_to_frequencies()
+            return calibration_data
+        data = np.loadtxt(logname, comments='#', delimiter=',')
+    calibration_data = helper.process_accelerometer_data(data)
+    calibration_data.normalize_to_frequencies()
+    return calibration_data
+
+def run_serial(helper, datas, shapers, options):
+    # Fit one shaper at a time in this process
+    shaper_cfgs = [cfg for cfg in shaper_defs.INPUT_SHAPERS
+                   if cfg.name in shapers]
+    results = []
+    for calibration_data in datas:
+        all_shapers = [helper.fit_shaper(
+            cfg, calibration_data, None, None, options.scv,
+            options.max_smoothing, None, None) for cfg in shaper_cfgs]
+        results.append((helper._select_best_shaper(all_shapers), all_shapers))
+    return results
+
+def run_parallel(helper, datas, shapers, options):
+    return helper.find_best_shapers(datas, shapers, scv=options.scv,
+                                    max_smoothing=options.max_smoothing)
+
+def main():
+    usage = "%prog [options] <raw or resonances data file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of timed runs")
+    opts.add_option("-a", "--axes", type="int", dest="axes", default=2,
+                    help="number of axes to calibrate with the data")
+    opts.add_option("-s", "--max_smoothing", type="float", dest="max_smoothing",
+                    default=None, help="maximum shaper smoothing to allow")
+    opts.add_option("--scv", type="float", dest="scv", default=5.,
+                    help="square corner velocity")
+    opts.add_option("--shapers", type="string", dest="shapers", default=None,
+                    help="a comma-separated list of shapers to test")
+    opts.add_option("--serial", action="store_true", dest="serial",
+                    help="also time fitting one shaper at a time")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+    start = time.perf_counter()
+    calibration_data = load_data(helper, args[0])
+    print("loaded %s in %.3fs" % (args[0], time.perf_counter() - start))
+    datas = [calibration_data] * options.axes
+    shapers = shaper_calibrate.AUTOTUNE_SHAPERS
+    if options.shapers:
+        shapers = [s.strip().lower() for s in options.shapers.split(',')]
+    tests = [("parallel", run_parallel)]
+    if options.serial:
+        tests.append(("serial", run_serial))
+    for name, func in tests:
+        times = []
+        for i in range(options.repeat):
+            start = time.perf_counter()
+            results = func(helper, datas, shapers, options)
+            times.append(time.perf_counter() - start)
+        best_shaper = results[0][0]
+        print("%-8s best %.3fs avg %.3fs (%d axes, %d shapers): %s @ %.1f Hz"
+              % (name, min(times), sum(times) / len(times), len(datas),
+                 len(results[0][1]), best_shaper.name, best_shaper.freq))
+
+if __name__ == '__main__':
+    main()